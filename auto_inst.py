@@ -1,21 +1,100 @@
 from logic import equals, TermBool, TermInt, conjunction, disjunction, Substitution
+from collections import defaultdict
+import bisect
 import itertools
 
+# Index of ground atoms for the retrieval of matching candidates.
+# Atoms are bucketed by their head function with arity, and by their type
+# for templates that can match anything (variables, linear combinations).
+# Buckets keep the order of insertion together with the position
+# of every atom, so a range of positions can be retrieved,
+# such as the atoms added in the last instantiation round.
+# A layer shares the atoms of its base index up to the size the base had,
+# and keeps only the atoms added to it, the base can still grow.
+# After max_depth layers, layer makes a copy instead so that lookups
+# don't go through a long chain of bases.
+
+class TermIndex:
+    max_depth = 8
+
+    def __init__(self, base = None):
+        self.base = base
+        self.depth = 0 if base is None else base.depth + 1
+        self.base_size = 0 if base is None else len(base)
+        self.size = self.base_size
+        self.buckets = defaultdict(lambda: ([], [])) # key -> positions, terms
+        self.positions = dict() # term -> position
+
+    def __len__(self):
+        return self.size
+    def __contains__(self, term):
+        return self.position(term) is not None
+
+    def position(self, term):
+        res = self.positions.get(term)
+        if res is None and self.base is not None:
+            res = self.base.position(term)
+            if res is not None and res >= self.base_size: res = None
+        return res
+
+    def layer(self):
+        if self.depth >= self.max_depth: return self.clone()
+        return TermIndex(self)
+
+    # the atoms in the order of their positions
+    def __iter__(self):
+        if self.base is not None:
+            yield from itertools.islice(self.base, self.base_size)
+        yield from self.positions
+
+    # a copy without a base
+    def clone(self):
+        res = TermIndex()
+        for term in self: res.add(term)
+        return res
+
+    def add(self, term):
+        for key in (type(term), (term.f, len(term.args))):
+            positions, terms = self.buckets[key]
+            positions.append(self.size)
+            terms.append(term)
+        self.positions[term] = self.size
+        self.size += 1
+
+    @staticmethod
+    def _key(template):
+        if template.f is None or template.f == TermInt._mk: return type(template)
+        else: return (template.f, len(template.args))
+
+    def candidates(self, template, start = 0, end = None):
+        if end is None: end = self.size
+        res = []
+        if self.base is not None and start < self.base_size:
+            res = self.base.candidates(template, start, min(end, self.base_size))
+        key = self._key(template)
+        if key not in self.buckets: return res
+        positions, terms = self.buckets[key]
+        lo = bisect.bisect_left(positions, start)
+        hi = bisect.bisect_left(positions, end)
+        if not res: return terms[lo:hi]
+        return res + terms[lo:hi]
+
 class MatchTerm:
     def __init__(self, terms):
         self.terms = terms
         assert len(self.terms) > 0
-    def matches(self, ground_terms):
-        return self._match_rec(ground_terms, 0, Substitution({}))
-    def _match_rec(self, ground_terms, i, subst0):
+    # matches against the atoms of a TermIndex at positions start..end
+    def matches(self, index, start = 0, end = None):
+        return self._match_rec(index, start, end, 0, Substitution({}))
+    def _match_rec(self, index, start, end, i, subst0):
         if i == len(self.terms):
             yield subst0
         else:
             term = self.terms[i]
-            for ground_term in ground_terms:
+            for ground_term in index.candidates(term, start, end):
                 subst1 = self._match1(term, subst0[ground_term])
                 if subst1 is not None:
-                    yield from self._match_rec(ground_terms, i+1, subst1)
+                    yield from self._match_rec(index, start, end, i+1, subst1)
     @staticmethod
     def _match1(template, ground):
         stack = [(template, ground)]
@@ -58,17 +137,19 @@ class AbstractAutoInstance:
     def __init__(self, generic, matches):
         self.generic = generic
         self.matches = matches
-    def get_instances(self, ground_terms):
+    def get_instances(self, index, start = 0, end = None):
         for m in self.matches:
-            for subst in m.matches(ground_terms):
+            for subst in m.matches(index, start, end):
                 yield subst[self.generic]
 
 class AutoInstance(AbstractAutoInstance):
     def __init__(self, generic):
-        free_vars = set(x for x in generic.all_vars if x.is_free_var)
+        free_mask = 0
+        for x in generic.all_vars:
+            if x.is_free_var: free_mask |= x.var_mask
         matches = []
         for leaf in generic.leaf_iter(self._is_leaf):
-            if free_vars <= leaf.all_vars:
+            if not (free_mask & ~leaf.var_mask):
                 matches.append(MatchTerm([leaf]))
         if not matches:
             raise Exception(f"Didn't find a single atom covering all free variables: {generic}")
@@ -87,7 +168,8 @@ if __name__ == "__main__":
     from logic import Jump
     thm = AutoInstance(Jump.X.length > 0)
     jump = Jump.fixed_var("jump")
-    terms = [jump.length]
+    terms = TermIndex()
+    terms.add(jump.length)
     print(thm.matches[0].terms[0])
     print("Instances:")
     for x in thm.get_instances(terms):
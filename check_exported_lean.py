@@ -1,7 +1,8 @@
 #!/usr/bin/python3
 
 from parser import parse_problem_stream
-from prover import prove_contradiction, constraints_to_lia, get_univ_theorems, FailedProof
+from prover import prove_contradiction, constraints_to_lia, get_univ_theorems, FailedProof, SolverUnknown, portfolio_solvers
+from smt_lia import SolverPortfolio, SolverLimits
 import sys
 import argparse
 
@@ -18,7 +19,11 @@ cmd_parser.add_argument('--instantiate',  default=False, action=argparse.Boolean
 cmd_parser.add_argument('--congruence',  default=False, action=argparse.BooleanOptionalAction,
                         help = "Add congruence rules to the SMT solver")
 cmd_parser.add_argument('--solver',  default=None, type=str,
-                        help = "Solver to run: z3, cvc4, cvc5, or a full command. If not specified, print smt input")
+                        help = "Solver to run: z3, cvc4, cvc5, portfolio (race all three), or a full command. If not specified, print smt input")
+cmd_parser.add_argument('--timeout',  default=None, type=float,
+                        help = "Time limit for the solver in seconds")
+cmd_parser.add_argument('--memory',  default=None, type=int,
+                        help = "Memory limit for the solver in megabytes")
 
 config = cmd_parser.parse_args()
 
@@ -45,8 +50,10 @@ if config.solver is None:
         sys.stdout,
     )
 else:
+    limits = SolverLimits(timeout = config.timeout, memory = config.memory)
     if config.solver == 'z3': solver_cmd = ('z3', '-in', '-smt2')
     elif config.solver in ('cvc4', 'cvc5'): solver_cmd = (config.solver, '-m', '--lang', 'smt')
+    elif config.solver == 'portfolio': solver_cmd = SolverPortfolio(portfolio_solvers, limits = limits)
     else: solver_cmd = tuple(config.solver.split(' '))
     try:
         prove_contradiction(
@@ -55,8 +62,11 @@ else:
             max_inst_iters = max_inst_iters,
             congruence = config.congruence,
             solver_cmd = solver_cmd,
+            limits = limits,
         )
         print("Proven")
+    except SolverUnknown as e:
+        print(f"Unknown ({e.reason})")
     except FailedProof as e:
         print(e)
         print("No contradiction found. Satisfiable?")
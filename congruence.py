@@ -0,0 +1,105 @@
+from logic import equals, conjunction, TermBool, TermInt
+
+# Union-find over terms, compared by identity thanks to hash-consing.
+# Every class remembers a constant it contains (a numeral, or true / false),
+# so that classes known to be distinct can be recognized.
+
+class TermUnionFind:
+    def __init__(self):
+        self.parent = dict()
+        self.value = dict()
+
+    def find(self, term):
+        root = self.parent.get(term)
+        if root is None:
+            self.parent[term] = term
+            if self.is_value(term): self.value[term] = term
+            return term
+        path = []
+        while root is not term:
+            path.append(term)
+            term = root
+            root = self.parent[term]
+        for x in path: self.parent[x] = root
+        return root
+
+    @staticmethod
+    def is_value(term):
+        if isinstance(term, TermInt): return term.is_num_const
+        else: return term in (TermBool.true, TermBool.false)
+
+    # returns True if two different classes got merged
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a is b: return False
+        self.parent[b] = a
+        if a not in self.value and b in self.value:
+            self.value[a] = self.value[b]
+        return True
+
+    def distinct(self, a, b):
+        a = self.value.get(self.find(a))
+        b = self.value.get(self.find(b))
+        return a is not None and b is not None and a is not b
+
+# Congruence closure of the equalities known from the top-level constraints.
+# The atoms come grouped by their skeleton together with their LIA arguments
+# (see LiaChecker.get_skeleton). Atoms with arguments in the same classes
+# get merged until fixpoint, so the solver needs only
+# * a single equality between an atom and the representative of its class,
+# * an implication between every two remaining classes of a skeleton,
+#   unless some of their arguments are known to be distinct.
+
+class CongruenceClosure:
+    def __init__(self, groups, constraints):
+        self.groups = groups
+        self.uf = TermUnionFind()
+        for constraint in constraints:
+            self.add_fact(constraint)
+        self.close()
+
+    def add_fact(self, constraint):
+        if constraint.f == conjunction:
+            for arg in constraint.args: self.add_fact(arg)
+        elif constraint.f == equals:
+            self.uf.union(*constraint.args)
+        elif constraint.f == TermBool.invert:
+            self.uf.union(TermBool.false, constraint.args[0])
+        else:
+            self.uf.union(TermBool.true, constraint)
+
+    def signature(self, arg_list):
+        return tuple(self.uf.find(arg) for arg in arg_list)
+
+    def close(self):
+        changed = True
+        while changed:
+            changed = False
+            for instances in self.groups:
+                signature_to_term = dict()
+                for term, arg_list in instances:
+                    term2 = signature_to_term.setdefault(self.signature(arg_list), term)
+                    if self.uf.union(term2, term): changed = True
+
+    def get_theorems(self):
+        find = self.uf.find
+        for instances in self.groups:
+            classes = dict()
+            for term, arg_list in instances:
+                signature = self.signature(arg_list)
+                rep = classes.get(signature)
+                if rep is None: classes[signature] = (term, arg_list)
+                else: yield equals(term, rep[0])
+            classes = list(classes.values())
+            for i, (term, arg_list) in enumerate(classes):
+                for term2, arg_list2 in classes[:i]:
+                    assert type(term) == type(term2)
+                    if find(term) is find(term2): continue
+                    if any(self.uf.distinct(arg1, arg2) for arg1, arg2 in zip(arg_list, arg_list2)):
+                        continue
+                    yield ~conjunction(*(
+                        equals(arg1, arg2)
+                        for arg1, arg2 in zip(arg_list, arg_list2)
+                        if find(arg1) is not find(arg2)
+                    )) | equals(term, term2)
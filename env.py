@@ -1,11 +1,13 @@
 import sys
+import asyncio
 import itertools
 from itertools import combinations
 
-from smt_lia import LiaChecker
+from smt_lia import LiaChecker, SmtSession, UnsatCoreIndex, no_limits
+from persistent import PersistentList, PersistentMap
 from logic import *
 import prover
-from prover import FailedProof, simplify_exist_clause
+from prover import FailedProof, SolverUnknown, simplify_exist_clause
 import export_to_lean
 
 class FailedProofDisjoint(FailedProof):
@@ -45,9 +47,12 @@ class FailedProofDisjoint(FailedProof):
         return "Disjointness Proof Failed!\n"+self.boom_str()
 
 class FailedProofSubgoal(FailedProof):
-    def __init__(self, subgoal):
+    def __init__(self, subgoal, reason = None):
         self.subgoal = subgoal
+        self.reason = reason
     def __str__(self):
+        if self.reason is not None:
+            return f"Failed to prove ({self.reason}): {self.subgoal}"
         return f"Failed to prove: {self.subgoal}"
 
 class AnnotatedFact:
@@ -58,23 +63,40 @@ class AnnotatedFact:
         self.deconstruction = deconstruction
 
 class LogicContext:
-    def __init__(self, facts, var_to_value, model_constraints, cached_model):
-        self.facts = list(facts)
-        self.var_to_value = dict(var_to_value)
-        self.model_constraints = list(model_constraints)
+    def __init__(self, facts, var_to_value, model_constraints, cached_model, session = None, compiled = None):
+        # persistent collections, a clone shares them with the original
+        self.facts = PersistentList(facts)
+        self.var_to_value = PersistentMap(var_to_value)
+        self.model_constraints = PersistentList(model_constraints)
         self._model = cached_model
+        self._model_candidate = cached_model # the last model, reused if still valid
+        self.session = session # SmtSession shared among clones
+        # prover.CompiledFacts of raw_facts, built lazily, shared among clones
+        # until one of them adds a fact to its own layer over the shared one
+        self._compiled = compiled
+        self._compiled_owned = False
 
     @property
     def raw_facts(self):
         return [fact.prop for fact in self.facts]
 
+    @property
+    def compiled(self):
+        if self._compiled is None:
+            self._compiled = prover.CompiledFacts(self.raw_facts)
+            self._compiled_owned = True
+        return self._compiled
+
     def clone(self):
-        return LogicContext(self.facts, self.var_to_value, self.model_constraints, self._model)
+        self._compiled_owned = False
+        res = LogicContext(self.facts, self.var_to_value, self.model_constraints, self._model, self.session, self._compiled)
+        res._model_candidate = self._model_candidate
+        return res
 
     def add_var(self, v):
         assert v.is_fixed_var
         assert v not in self.var_to_value
-        self.var_to_value[v] = None
+        self.var_to_value = self.var_to_value.set(v, None)
         self._model = None
 
     def add_fact(self, prop, assumed = False, deconstruction = False):
@@ -83,26 +105,31 @@ class LogicContext:
             if v.is_fixed_var and v not in self.var_to_value:
                 cur_vars = list(self.var_to_value.keys())
                 raise Exception(f"Variable {v} in {prop} not covered by current variables: {cur_vars}")
-        self.facts.append(AnnotatedFact(prop, assumed = assumed, deconstruction = deconstruction))
+        self.facts = self.facts.append(AnnotatedFact(prop, assumed = assumed, deconstruction = deconstruction))
         self._model = None
+        if self._compiled is not None:
+            if not self._compiled_owned:
+                self._compiled = self._compiled.layer()
+                self._compiled_owned = True
+            self._compiled.add_fact(prop)
 
     def add_model_constraints(self, *props, prioritized = True):
         assert all(isinstance(prop, TermBool) for prop in props)
         if prioritized:
-            self.model_constraints = list(props) + self.model_constraints
+            self.model_constraints = PersistentList(props).extend(self.model_constraints)
         else:
-            self.model_constraints.extend(self.model_constraints)
+            self.model_constraints = self.model_constraints.extend(props)
         self._model = None
 
     def deconstruct(self, v, value):
         assert v.is_fixed_var
         assert v in self.var_to_value
         assert self.var_to_value[v] is None
-        self.var_to_value[v] = value
+        self.var_to_value = self.var_to_value.set(v, value)
         for value_v in value.all_vars:
             assert value_v.is_fixed_var
             assert value_v not in self.var_to_value
-            self.var_to_value[value_v] = None
+            self.var_to_value = self.var_to_value.set(value_v, None)
         self.add_fact(equals(v, value), deconstruction = True)
 
     def undeconstruct(self, value):
@@ -111,10 +138,10 @@ class LogicContext:
             if prev_val == value:
                 break
         else:
-            if not value.all_vars:
+            if not value.var_mask:
                 return None
             for prev, prev_val in self.var_to_value.items():
-                if prev_val is not None and prev_val.all_vars == value.all_vars:
+                if prev_val is not None and prev_val.var_mask == value.var_mask:
                     break
             else:
                 return None
@@ -125,16 +152,17 @@ class LogicContext:
 
         # update self.var_to_value
         for v in prev_val.all_vars:
-            del self.var_to_value[v]
-        self.var_to_value[prev] = None
+            self.var_to_value = self.var_to_value.delete(v)
+        self.var_to_value = self.var_to_value.set(prev, None)
 
         # update facts
         def keep_prop(prop):
-            return not (value.all_vars & prop.all_vars)
+            return not (value.var_mask & prop.var_mask)
         def keep_fact(fact):
             return keep_prop(fact.prop)
-        self.facts = list(filter(keep_fact, self.facts))
-        self.model_constraints = list(filter(keep_prop, self.model_constraints))
+        self.facts = PersistentList(filter(keep_fact, self.facts))
+        self.model_constraints = PersistentList(filter(keep_prop, self.model_constraints))
+        self._compiled = None
         
         return prev
 
@@ -160,18 +188,20 @@ class LogicContext:
             print('  '*n + bullet + ' '+ str(fact.prop))
 
     def remove_facts(self, removed):
-        self.facts = list(filter(lambda fact: fact not in removed, self.facts))
+        self.facts = PersistentList(filter(lambda fact: fact not in removed, self.facts))
         self._model = None
+        self._compiled = None
 
     def remove_var(self, removed):
         assert removed in self.var_to_value and self.var_to_value[removed] is None
         for v, value in self.var_to_value.items():
-            if value is not None and removed in value.all_vars:
+            if value is not None and value.var_mask & removed.var_mask:
                 # TODO: allow removing multiple variables at once
-                assert len(value.all_vars) == 1
-                self.var_to_value[v] = None
-        self.facts = list(filter(lambda fact: removed not in fact.prop.all_vars, self.facts))
+                assert value.var_mask == removed.var_mask
+                self.var_to_value = self.var_to_value.set(v, None)
+        self.facts = PersistentList(filter(lambda fact: not (fact.prop.var_mask & removed.var_mask), self.facts))
         self._model = None
+        self._compiled = None
 
     def get_model(self):
         extra_terms = []
@@ -184,8 +214,16 @@ class LogicContext:
             else: cur_extra = []
             extra_terms.extend(cur_extra)
             if value is None: important_terms.extend(cur_extra)
-        model = prover.get_model(self.raw_facts, self.model_constraints, extra_terms = extra_terms)
+        # prover.get_model drops the model constraints it could not satisfy
+        kept = list(self.model_constraints)
+        model = prover.get_model(
+            self.raw_facts, kept,
+            extra_terms = extra_terms, session = self.session,
+            candidate = self._model_candidate, base = self.compiled,
+        )
         if model is None: return None
+        self.model_constraints = PersistentList(kept)
+        self._model_candidate = model
 
         # add model constraints to copy the found model
         known_values = set()
@@ -197,7 +235,7 @@ class LogicContext:
             known_values.add(a)
         for term in important_terms:
             if term in known_values: continue
-            self.model_constraints.append(equals(term, model[term]))
+            self.model_constraints = self.model_constraints.append(equals(term, model[term]))
 
         return model
 
@@ -208,7 +246,7 @@ class LogicContext:
         return self._model
 
     @staticmethod
-    def from_props(props, ini_vars):
+    def from_props(props, ini_vars, session = None):
         ini_vars_s = ini_vars
         for prop in props:
             for v in prop.all_vars:
@@ -219,6 +257,7 @@ class LogicContext:
             { v : None for v in ini_vars },
             [],
             None,
+            session,
         )
 
 def model_display_mines(mines, model):
@@ -226,7 +265,9 @@ def model_display_mines(mines, model):
     print(dummy.seq_str(mines))
 
 class GrasshopperEnv:
-    def __init__(self, auto_assume = False, record_uflia = False, record_lean = False, show_record_step = False):
+    def __init__(self, auto_assume = False, record_uflia = False, record_lean = False, show_record_step = False, solver_cmd = prover.default_session_solver, cache = None, limits = no_limits, split_unknown = True, concurrent = False, workers = None, slicing = False):
+        self.session = SmtSession(solver_cmd, cache, limits)
+        self.core_index = UnsatCoreIndex()
         self.size = TermInt.fixed_var('size')
         self.jumps = JumpSet.fixed_var('jumps')
         self.mines = MineField.fixed_var('mines')
@@ -240,6 +281,7 @@ class GrasshopperEnv:
         self.ctx = LogicContext.from_props(
             univ_theorems + ctx_theorems,
             [self.size, self.jumps, self.mines],
+            self.session,
         )
         self.ctx_stack = []
         self.proven = False
@@ -249,23 +291,102 @@ class GrasshopperEnv:
             'record_uflia' : record_uflia,
             'record_lean' : record_lean,
             'show_step' : show_record_step,
+            'session' : self.session,
+            'core_index' : self.core_index,
         }
         self.auto_assume = auto_assume
+        self.split_unknown = split_unknown # auto_assume also goals where the solver gave up
+        self.concurrent = concurrent # run solvers of independent goals at once
+        self.workers = workers # if set, independent goals are checked in a process pool
+        self.slicing = slicing # try the facts relevant to the goal first
+
+    # stops the solver process, also when the proof is left unfinished,
+    # the env can be used as a context manager doing so at the end
+    def close(self):
+        self.session.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
 
     def prove(self, goal):
         remains_to_check = []
         try:
-            prover.prove_contradiction(self.ctx.raw_facts + [~goal], **self.prover_kwargs)
+            if self.slicing: prove = prover.prove_contradiction_sliced
+            else: prove = prover.prove_contradiction
+            prove(self.ctx.raw_facts + [~goal], base = self.ctx.compiled, **self.prover_kwargs)
         except FailedProof as e:
+            unknown = isinstance(e, SolverUnknown)
             if goal.f == conjunction:
                 remains_to_check = goal.args
-            elif self.auto_assume:
+            elif self.auto_assume and (self.split_unknown or not unknown):
                 self.split_case(goal, automatic = True)
+            elif unknown:
+                raise FailedProofSubgoal(goal, e.reason) from e
             else:
                 raise FailedProofSubgoal(goal) from e
 
-        for subgoal in remains_to_check:
-            self.prove(subgoal)
+        self.prove_all(*remains_to_check)
+
+    # proves goals one by one, with concurrent = True or workers, the goals
+    # are first checked all together, and only the failed ones are processed again
+    # (inside a running event loop, concurrent goals are proven one by one,
+    # use prove_all_async there)
+    def prove_all(self, *goals):
+        recording = self.prover_kwargs['record_uflia'] or self.prover_kwargs['record_lean']
+        if len(goals) > 1 and not recording:
+            if self.workers is not None:
+                failures = self._prove_in_pool(
+                    [self.ctx.raw_facts + [~goal] for goal in goals],
+                    [self.ctx.compiled] * len(goals),
+                )
+                goals = [goal for goal, failure in zip(goals, failures) if failure is not None]
+            elif self.concurrent and not self._loop_running():
+                failures = asyncio.run(self._prove_all_async(goals))
+                goals = [goal for goal, failure in zip(goals, failures) if failure is not None]
+        for goal in goals:
+            self.prove(goal)
+
+    # the same as prove_all with concurrent = True, awaited in a running event loop
+    async def prove_all_async(self, *goals):
+        recording = self.prover_kwargs['record_uflia'] or self.prover_kwargs['record_lean']
+        if len(goals) > 1 and not recording:
+            failures = await self._prove_all_async(goals)
+            goals = [goal for goal, failure in zip(goals, failures) if failure is not None]
+        for goal in goals:
+            self.prove(goal)
+
+    @staticmethod
+    def _loop_running():
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    def _prove_in_pool(self, jobs, bases):
+        return prover.prove_in_pool(
+            jobs, self.workers, bases,
+            solver_cmd = self.session.cmd,
+            core_index = self.core_index,
+            limits = self.session.limits,
+        )
+
+    async def _prove_all_async(self, goals):
+        async def attempt(goal):
+            try:
+                await prover.prove_contradiction_async(
+                    self.ctx.raw_facts + [~goal],
+                    base = self.ctx.compiled,
+                    solver_cmd = self.session.cmd,
+                    cache = self.session.cache,
+                    core_index = self.core_index,
+                    limits = self.session.limits,
+                )
+            except FailedProof as e:
+                return e
+            return None
+        return await asyncio.gather(*(attempt(goal) for goal in goals))
 
     def split_case(self, prop, automatic = False):
         assert isinstance(prop, TermBool)
@@ -282,8 +403,10 @@ class GrasshopperEnv:
 
         assert isinstance(jumps, Jumps)
         # self.prove(equals(jumps.s, self.jumps))
-        self.prove(equals((jumps.s - self.jumps).length, 0))
-        self.prove(equals((self.jumps - jumps.s).length, 0))
+        self.prove_all(
+            equals((jumps.s - self.jumps).length, 0),
+            equals((self.jumps - jumps.s).length, 0),
+        )
 
         boom = TermInt.fixed_var('boom')
         landings_boom = jumps.landings[boom]
@@ -295,24 +418,30 @@ class GrasshopperEnv:
         try:
             prover.prove_contradiction(
                 self.ctx.raw_facts + [landings_boom, mines_boom],
+                base = self.ctx.compiled,
                 **self.prover_kwargs,
             )
         except FailedProof as e:
-            _, subst = prover.extract_subst(self.ctx.raw_facts)
-            landings_boom = subst[landings_boom]
-            mines_boom = subst[mines_boom]
-            for landings_boom_case in landings_boom.disj_args:
-                for mines_boom_case in mines_boom.disj_args:
-                    try:
-                        prover.prove_contradiction(
-                            self.ctx.raw_facts + [landings_boom_case, mines_boom_case]
-                        )
-                    except:
-                        boom_case = simplify_exist_clause(
-                            landings_boom_case & mines_boom_case,
-                            can_eliminate = lambda v: v == boom,
-                        )
-                        remaining_cases.append(boom_case)
+            _, subst = prover.extract_subst(self.ctx.raw_facts, self.ctx.compiled)
+            landings_boom = normal_form(subst[landings_boom])
+            mines_boom = normal_form(subst[mines_boom])
+            boom_cases = [
+                (landings_boom_case, mines_boom_case)
+                for landings_boom_case in landings_boom.disj_args
+                for mines_boom_case in mines_boom.disj_args
+            ]
+            failures = prover.prove_contradiction_cases(
+                self.ctx.raw_facts, boom_cases,
+                session = self.session,
+                base = self.ctx.compiled,
+            )
+            for (landings_boom_case, mines_boom_case), failure in zip(boom_cases, failures):
+                if failure is None: continue
+                boom_case = simplify_exist_clause(
+                    landings_boom_case & mines_boom_case,
+                    can_eliminate = lambda v: v == boom,
+                )
+                remaining_cases.append(boom_case)
             if any(boom in boom_case.all_vars for boom_case in remaining_cases) or not self.auto_assume:
                 if e.model is not None:
                     raise FailedProofDisjoint(
@@ -329,6 +458,34 @@ class GrasshopperEnv:
 
         self._next_goal()
 
+    # tries to close the pending goals on ctx_stack without any further steps,
+    # i.e. the assumptions of the case are already contradictory,
+    # the contexts are checked in the process pool if workers are set
+    # (not when recording, the workers don't record the problems),
+    # and the closed ones are reported and removed in the stack order.
+    # It is an explicit step, removing contexts changes which goal
+    # the next steps of a solution script work on.
+    def close_pending(self):
+        if not self.ctx_stack: return
+        jobs = [ctx.raw_facts for ctx in self.ctx_stack]
+        bases = [ctx.compiled for ctx in self.ctx_stack]
+        recording = self.prover_kwargs['record_uflia'] or self.prover_kwargs['record_lean']
+        if self.workers is not None and not recording:
+            failures = self._prove_in_pool(jobs, bases)
+        else:
+            failures = []
+            for constraints, base in zip(jobs, bases):
+                try:
+                    prover.prove_contradiction(constraints, base = base, **self.prover_kwargs)
+                    failures.append(None)
+                except FailedProof:
+                    failures.append("failed")
+        remaining = []
+        for ctx, failure in zip(self.ctx_stack, failures):
+            if failure is None: ctx.show_last_assump(' #')
+            else: remaining.append(ctx)
+        self.ctx_stack = remaining
+
     def _next_goal(self):
         if self.ctx_stack:
             self.ctx = self.ctx_stack.pop()
@@ -336,6 +493,7 @@ class GrasshopperEnv:
         else:
             self.ctx = None
             self.proven = True
+            self.session.close()
             if self.prover_kwargs['record_lean']:
                 export_to_lean.finish_export()
 
@@ -133,7 +133,7 @@ def finish_export():
     export_stream = sys.stdout
 
 def export_problem(constraints, problem_num):
-    constraints = constraints[skip_first:]
+    constraints = [normal_form(constraint) for constraint in constraints[skip_first:]]
     fixed_vars = set()
     for constraint in constraints:
         fixed_vars.update(
@@ -805,7 +805,7 @@ class GrasshopperGui(Gtk.Window):
 
     def reset_mines(self):
         self.selection = set()
-        _, subst = extract_subst(self.env.ctx.raw_facts)
+        _, subst = extract_subst(self.env.ctx.raw_facts, self.env.ctx.compiled)
         mines = subst[self.env.mines]
         part_to_remain = defaultdict(int)
         for part in mines.subsequences:
@@ -1,7 +1,8 @@
-from weakref import WeakValueDictionary
+from weakref import WeakValueDictionary, finalize
 from collections import defaultdict
 from arith_pair import ArithPair
 import itertools
+import math
 
 FREE_VAR = "FREE_VAR"
 SHARED_VAR = "SHARED_VAR"
@@ -11,31 +12,58 @@ class classproperty(property):
     def __get__(self, cls, owner):
         return classmethod(self.fget).__get__(None, owner)()
 
+# Terms are slotted, every subclass declares the slots of its extra attributes.
+# Every term gets an interned integer id on creation, used also as its hash,
+# the equality stays by identity as the terms are hash-consed.
+# Every variable gets a small index, reused after the variable is collected,
+# and every term stores the bitmask of its variables (var_mask),
+# all_vars is the frozenset view of the mask computed lazily.
+
 class Term:
+    __slots__ = (
+        'f', 'args', 'meta_args', 'var_name', 'var_type', 'var_index', 'var_mask', '_all_vars',
+        'is_var', 'is_constant', 'id', '_subterms', '_normal_form', '_initialized', '__weakref__',
+    )
 
     _X = None
+    _ids = itertools.count()
+    _var_indices = itertools.count()
+    _free_var_indices = []
+    _vars_by_index = WeakValueDictionary()
 
     def __init__(self, direct_f = None, direct_args = (), direct_meta_args = None, direct_var_name = None, direct_var_type = None):
-        if self.initialized: return
+        if self._initialized: return
+        self.id = next(Term._ids)
         self.f = direct_f
         self.args = direct_args
         self.meta_args = direct_meta_args
         self.var_name = direct_var_name
         self.var_type = direct_var_type
         self._all_vars = None
+        self._subterms = None
+        self._normal_form = None
         if self.f is None:
             assert self.args == ()
             assert self.meta_args is None
             assert isinstance(self.var_name, str)
             assert self.var_type in (FREE_VAR, SHARED_VAR, FIXED_VAR)
             self.is_var = True
+            self.var_index = Term._alloc_var_index(self)
+            self.var_mask = 1 << self.var_index
         else:
             assert direct_var_type == None
             assert isinstance(self.f, Constant)
             assert self.args is not None
             assert self.meta_args is not None
             self.is_var = False
+            self.var_index = None
+            self.var_mask = 0
+            for arg in self.args: self.var_mask |= arg.var_mask
         self.is_constant = len(self.args) == 0
+        self._initialized = True
+
+    def __hash__(self):
+        return self.id
 
     def __new__(cls, *args,  **kwargs):
         if cls == Term:
@@ -45,6 +73,7 @@ class Term:
         if len(args) == 1 and not kwargs and isinstance(args[0], cls): return args[0]
         if 'direct_f' in kwargs or 'direct_var_name' in kwargs:
             res = super().__new__(cls)
+            res._initialized = False
         else:
             assert 'direct_args' not in kwargs
             assert 'direct_meta_args' not in kwargs
@@ -63,13 +92,30 @@ class Term:
 
     @property
     def initialized(self):
-        return hasattr(self, 'f')
+        return self._initialized
+
+    @staticmethod
+    def _alloc_var_index(v):
+        if Term._free_var_indices: index = Term._free_var_indices.pop()
+        else: index = next(Term._var_indices)
+        Term._vars_by_index[index] = v
+        finalize(v, Term._free_var_indices.append, index)
+        return index
+
+    # the frozenset of the variables in the mask
+    @staticmethod
+    def mask_to_vars(mask):
+        res = []
+        while mask:
+            low = mask & -mask
+            res.append(Term._vars_by_index[low.bit_length() - 1])
+            mask ^= low
+        return frozenset(res)
 
     @property
     def all_vars(self):
         if self._all_vars is None:
-            if self.is_var: self._all_vars = frozenset((self,))
-            else: self._all_vars = frozenset().union(*(arg.all_vars for arg in self.args))
+            self._all_vars = Term.mask_to_vars(self.var_mask)
         return self._all_vars
 
     __match_args__ = ['f', 'args']
@@ -131,19 +177,165 @@ class Term:
     def value(self):
         raise Exception("Not implemented")
 
+    # The traversals go over the term as a DAG with an explicit stack,
+    # so every distinct subterm is visited once and deep terms
+    # (such as long TermSequence.concat chains) don't hit the recursion limit.
+
     def leaf_iter(self, is_leaf):
-        if is_leaf(self):
-            yield self
-        elif self.is_var: return
-        else:
-            for arg in self.args:
-                yield from arg.leaf_iter(is_leaf)
+        visited = set()
+        stack = [self]
+        while stack:
+            term = stack.pop()
+            if term in visited: continue
+            visited.add(term)
+            if is_leaf(term): yield term
+            elif not term.is_var: stack.extend(reversed(term.args))
+
+    # distinct subterms in the pre-order, cached on the term,
+    # the cached lists of the subterms get reused
+    @property
+    def subterms(self):
+        if self._subterms is None:
+            res = []
+            visited = set()
+            stack = [self]
+            while stack:
+                term = stack.pop()
+                if term in visited: continue
+                if term._subterms is not None and term is not self:
+                    for subterm in term._subterms:
+                        if subterm in visited: continue
+                        visited.add(subterm)
+                        res.append(subterm)
+                    continue
+                visited.add(term)
+                res.append(term)
+                if not term.is_var: stack.extend(reversed(term.args))
+            self._subterms = tuple(res)
+        return self._subterms
 
     def subterms_iter(self):
-        yield self
-        if not self.is_var:
-            for arg in self.args:
-                yield from arg.subterms_iter()
+        return iter(self.subterms)
+
+# Central interning table of the terms built by Constants.
+# The lookups go to weak dictionaries, so a term alive anywhere is always
+# found again and hash-consing stays exact. Besides, the table keeps strong
+# references to the recently used terms, so that hot intermediate terms
+# don't get collected and rebuilt: a used term goes to the current
+# generation, and when it gets full, the oldest of max_generations
+# is released. max_generations = 0 keeps weak references only.
+# Hits, misses and evictions are counted per name of the function symbol,
+# the statistics must not keep the symbols alive (such as the definition
+# atoms of a clausified problem, see Clausifier).
+
+class TermTable:
+    def __init__(self, generation_size = 50000, max_generations = 4):
+        self.arg_cache = WeakValueDictionary() # (f, args, meta_args) -> term
+        self.build_cache = WeakValueDictionary() # (f, result of build) -> term
+        self.set_retention(generation_size, max_generations)
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evictions = defaultdict(int)
+
+    def set_retention(self, generation_size, max_generations):
+        self.generation_size = generation_size
+        self.max_generations = max_generations
+        self.generations = [set()]
+
+    def retain(self, term):
+        if self.max_generations == 0: return
+        generation = self.generations[-1]
+        generation.add(term)
+        if len(generation) < self.generation_size: return
+        self.generations.append(set())
+        if len(self.generations) <= self.max_generations: return
+        released = self.generations.pop(0)
+        for term in released:
+            if any(term in generation for generation in self.generations): continue
+            self.evictions[term.f.name] += 1
+
+    def lookup(self, f, arg_cache_key):
+        term = self.arg_cache.get((f, arg_cache_key))
+        if term is None: self.misses[f.name] += 1
+        else:
+            self.hits[f.name] += 1
+            self.retain(term)
+        return term
+
+    def store(self, f, arg_cache_key, built, make_term):
+        term = self.build_cache.get((f, built))
+        if term is None:
+            term = make_term()
+            self.build_cache[f, built] = term
+        self.arg_cache[f, arg_cache_key] = term
+        self.retain(term)
+        return term
+
+    def show_stats(self, limit = 20):
+        print(f"Term table: {len(self.arg_cache)} argument entries, {len(self.build_cache)} terms")
+        names = sorted(set(self.hits) | set(self.misses), key = lambda name: -(self.hits[name] + self.misses[name]))
+        for name in names[:limit]:
+            print(f"  {name}: {self.hits[name]} hits, {self.misses[name]} misses, {self.evictions[name]} evictions")
+
+term_table = TermTable()
+
+# Rewrite rules indexed by the head symbol. The builders of the Constants
+# keep the terms canonical (flattening, linear normalization, ...) eagerly,
+# while the rules here expand a term into a bigger one, so they fire only
+# when a consumer (the prover, an exporter) asks for the normal form.
+# The normal form is computed bottom-up with an explicit stack,
+# and cached on every visited term.
+
+class RewriteRules:
+    def __init__(self):
+        self.rules = defaultdict(list) # head symbol -> [term -> term / None]
+        self.fired = defaultdict(int)
+
+    # decorator registering a rule for the head symbol
+    def rule(self, head):
+        def register(rule):
+            self.rules[head].append(rule)
+            return rule
+        return register
+
+    def normal_form(self, term):
+        if term._normal_form is not None: return term._normal_form
+        stack = [(term, False)]
+        while stack:
+            t, args_done = stack.pop()
+            if t._normal_form is not None: continue
+            if t.is_var:
+                t._normal_form = t
+            elif not args_done:
+                stack.append((t, True))
+                stack.extend((arg, False) for arg in t.args if arg._normal_form is None)
+            else:
+                args = tuple(arg._normal_form for arg in t.args)
+                if all(a is b for a,b in zip(args, t.args)): res = t
+                else: res = t.f(*args, **t.meta_args)
+                if res is not t: res = self.normal_form(res)
+                else: res = self._rewrite_top(t)
+                t._normal_form = res
+        return term._normal_form
+
+    # the term has arguments in normal form
+    def _rewrite_top(self, term):
+        for rule in self.rules.get(term.f, ()):
+            res = rule(term)
+            if res is not None:
+                self.fired[term.f] += 1
+                return self.normal_form(res)
+        return term
+
+    def show_stats(self):
+        print("Rewrite rules fired:")
+        for f, count in sorted(self.fired.items(), key = lambda x: -x[1]):
+            print(f"  {f.name}: {count}")
+
+rewrite_rules = RewriteRules()
+
+def normal_form(term):
+    return rewrite_rules.normal_form(term)
 
 class Constant:
     def __init__(self, build, name, out_type):
@@ -151,8 +343,7 @@ class Constant:
         self.name = name
         if out_type is None: self.out_type = None
         else: self.out_type = Term.to_type(out_type)
-        self._arg_cache = WeakValueDictionary()
-        self._build_cache = WeakValueDictionary()
+        self.definition = None # set for definition atoms, see Clausifier
 
         def notation(*args, **kwargs):
             if not args and not kwargs: return self.name
@@ -170,20 +361,21 @@ class Constant:
             raise Exception(f"out_type of {self.name} has not been set")
         args = tuple(Term.to_term(arg) for arg in args)
         arg_cache_key = args, tuple(meta_args.items())
-        term = self._arg_cache.get(arg_cache_key)
+        term = term_table.lookup(self, arg_cache_key)
         if term is None:
 
             x = self._build(*args, **meta_args)
             if x is None: x = arg_cache_key
             if Term.to_type(type(x)) == self.out_type:
                 term = Term.to_term(x)
+                term_table.arg_cache[self, arg_cache_key] = term
+                term_table.retain(term)
             else:
                 assert not isinstance(x, Term)
-                term = self._build_cache.get(x)
-                if term is None:
-                    term = self.out_type.make_app(self, args, meta_args)
-                    self._build_cache[x] = term
-            self._arg_cache[arg_cache_key] = term
+                term = term_table.store(
+                    self, arg_cache_key, x,
+                    lambda: self.out_type.make_app(self, args, meta_args),
+                )
 
         return term
 
@@ -199,6 +391,8 @@ def term_fun(build):
     return Constant(build, name, out_type)
 
 class TermBool(Term):
+    __slots__ = ()
+
     @staticmethod
     def mk(value):
         assert isinstance(value, (bool,int))
@@ -289,45 +483,28 @@ class TermBool(Term):
         else: return (self,)
 
     # clausification
-    def clausify_raw(self):
-        if self.f == equals and isinstance(self.args[0], TermBool):
-            a,b = self.args
-            na = (~a).clausify_raw()
-            nb = (~b).clausify_raw()
-            a = a.clausify_raw()
-            b = b.clausify_raw()
-            return (na | b) & (a | nb)
-        elif self.f == conjunction:
-            return conjunction(*(x.clausify_raw() for x in self.args))
-        elif self.f == disjunction:
-            options = [x.clausify_raw().conj_args for x in self.args]
-            return conjunction(*(
-                disjunction(*option)
-                for option in itertools.product(*options)
-            ))
-        else:
-            return self
+    def clausify_raw(self, max_clauses = 16, definition_atoms = None):
+        return Clausifier(max_clauses, definition_atoms).clausify(self)
     def drop_subsumed_clauses(self):
-        clauses_d = defaultdict(list)
-        for clause in self.conj_args:
-            clauses_d[len(clause.disj_args)].append(clause)
-        clauses_sorted = [
-            clauses
-            for l, clauses in sorted(clauses_d.items())
+        # shorter clauses first, so only forward subsumption is needed
+        clauses = sorted(self.conj_args, key = lambda clause: len(clause.disj_args))
+        index = SubsumptionIndex()
+        res = [
+            clause for clause in clauses
+            if not index.is_subsumed(clause) and index.add(clause)
         ]
-        res = []
-        res_sets = []
-        for clauses in clauses_sorted:
-            cur_sets = []
-            for clause in clauses:
-                s = set(clause.disj_args)
-                if any(x <= s for x in res_sets): continue
-                cur_sets.append(s)
-                res.append(clause)
-            res_sets.extend(cur_sets)
         return conjunction(*res)
-    def clausify(self):
-        return self.clausify_raw().drop_subsumed_clauses()
+    def clausify(self, definition_atoms = None):
+        return self.clausify_raw(definition_atoms = definition_atoms).drop_subsumed_clauses()
+
+    @property
+    def is_definition(self):
+        return self.f is not None and self.f.definition is not None
+    # the clauses defining a definition atom, instantiated to its arguments
+    def unfold_definition(self):
+        vs, clauses = self.f.definition
+        subst = Substitution(dict(zip(vs, self.args)))
+        return [~self | subst[clause] for clause in clauses]
 
     def value(self):
         if self == TermBool.true: return True
@@ -394,6 +571,194 @@ def disjunction(*args):
 
     return disjunction(*res)
 
+# Definitional (Tseitin) clausification. Disjunctions are distributed
+# over conjunctions while it gives at most max_clauses clauses,
+# bigger arguments are replaced by a definition atom: a fresh predicate
+# applied to the free variables of the argument, so they stay quantified.
+# The definition clauses  ~atom | clause  are added to the result
+# (the argument occurs positively, so the other direction is not needed).
+# definition_atoms (formula -> atom) is shared by the clausifications
+# of one problem (see prover.CompiledFacts), so that a formula is named
+# by the same atom there, the predicates are numbered within it.
+# A predicate keeps the clauses of its formula as its definition, without
+# its atoms: the TermTable entries of the atoms refer to the predicate,
+# and must not keep the atoms alive once the problem is dropped.
+
+class Clausifier:
+    def __init__(self, max_clauses = 16, definition_atoms = None):
+        self.max_clauses = max_clauses
+        if definition_atoms is None: definition_atoms = dict()
+        self.definition_atoms = definition_atoms
+        self.cache = dict()
+        self.defined = set()
+        self.definitions = []
+
+    def clausify(self, prop):
+        clauses = self.clauses(prop)
+        return conjunction(*clauses, *self.definitions)
+
+    # returns a tuple of clauses, every shared subformula is processed once
+    def clauses(self, prop):
+        res = self.cache.get(prop)
+        if res is not None: return res
+        if prop.f == equals and isinstance(prop.args[0], TermBool):
+            a,b = prop.args
+            res = self.clauses(~a | b) + self.clauses(a | ~b)
+        elif prop.f == conjunction:
+            res = tuple(itertools.chain.from_iterable(
+                self.clauses(x) for x in prop.args
+            ))
+        elif prop.f == disjunction:
+            options = [self.clauses(x) for x in prop.args]
+            while math.prod(len(option) for option in options) > self.max_clauses:
+                i = max(range(len(options)), key = lambda i: len(options[i]))
+                options[i] = (self.define(prop.args[i]),)
+            res = tuple(
+                disjunction(*option)
+                for option in itertools.product(*options)
+            )
+        else:
+            res = (prop,)
+        self.cache[prop] = res
+        return res
+
+    def define(self, prop):
+        atom = self.definition_atoms.get(prop)
+        if atom is None:
+            vs = tuple(sorted(
+                (v for v in prop.all_vars if v.is_free_var),
+                key = lambda v: (v.var_name, type(v).__name__),
+            ))
+            pred = Constant(lambda *args: None, f"def{len(self.definition_atoms)}", TermBool)
+            atom = pred(*vs)
+            self.definition_atoms[prop] = atom
+            pred.definition = vs, self.clauses(prop)
+        if atom not in self.defined:
+            self.defined.add(atom)
+            self.definitions.extend(~atom | clause for clause in atom.f.definition[1])
+        return atom
+
+# Index of clauses (disjunctions of literals) for subsumption checks,
+# clauses can be added incrementally, with forward subsumption
+# (is the new clause subsumed?) and backward subsumption
+# (which clauses does the new one subsume?).
+# Every literal has an occurrence list of the clauses containing it,
+# and every clause a 64-bit signature of its literals,
+# a clause can only subsume clauses with a superset signature.
+# A layer shares the clauses of its base index, and keeps only the clauses
+# added to it and the clauses of the base removed from it,
+# the base must not change while the layer is in use.
+# After max_depth layers, layer makes a copy instead.
+
+class SubsumptionIndex:
+    max_depth = 8
+
+    def __init__(self, base = None):
+        self.base = base
+        self.depth = 0 if base is None else base.depth + 1
+        self.size = 0 if base is None else len(base)
+        self.clauses = dict() # clause -> literals, signature
+        self.occurrences = defaultdict(set)
+        self.removed = set() # clauses of the base removed in the layer
+
+    def __len__(self):
+        return self.size
+    def __contains__(self, clause):
+        return self._entry(clause) is not None
+
+    # the clauses, the ones of the base first
+    def __iter__(self):
+        if self.base is not None:
+            for clause in self.base:
+                if clause not in self.removed: yield clause
+        yield from self.clauses
+
+    def _entry(self, clause):
+        res = self.clauses.get(clause)
+        if res is None and self.base is not None and clause not in self.removed:
+            res = self.base._entry(clause)
+        return res
+
+    def _occurrences(self, literal):
+        res = self.occurrences.get(literal, ())
+        if self.base is None: return res
+        base = [clause for clause in self.base._occurrences(literal) if clause not in self.removed]
+        if not res: return base
+        return list(res) + base
+
+    def layer(self):
+        if self.depth >= self.max_depth: return self.clone()
+        return SubsumptionIndex(self)
+
+    # a copy without a base
+    def clone(self):
+        res = SubsumptionIndex()
+        for clause in self:
+            literals, signature = self._entry(clause)
+            res.clauses[clause] = literals, signature
+            for literal in literals:
+                res.occurrences[literal].add(clause)
+        res.size = len(res.clauses)
+        return res
+
+    @staticmethod
+    def signature(literals):
+        res = 0
+        for literal in literals: res |= 1 << (hash(literal) % 64)
+        return res
+
+    # returns True if the clause got added
+    def add(self, clause):
+        if clause in self: return False
+        literals = frozenset(clause.disj_args)
+        self.clauses[clause] = literals, self.signature(literals)
+        for literal in literals:
+            self.occurrences[literal].add(clause)
+        self.size += 1
+        return True
+
+    def remove(self, clause):
+        entry = self.clauses.pop(clause, None)
+        if entry is None:
+            self.removed.add(clause)
+        else:
+            for literal in entry[0]:
+                self.occurrences[literal].discard(clause)
+        self.size -= 1
+
+    # is there a clause in the index with a subset of literals of the given clause
+    def is_subsumed(self, clause):
+        literals = clause.disj_args
+        counts = defaultdict(int)
+        for literal in literals:
+            for clause2 in self._occurrences(literal):
+                counts[clause2] += 1
+                if counts[clause2] == len(self._entry(clause2)[0]): return True
+        return False
+
+    # clauses in the index with a superset of literals of the given clause
+    def subsumed_by(self, clause):
+        literals = frozenset(clause.disj_args)
+        occurrences = sorted((self._occurrences(literal) for literal in literals), key = len)
+        if not occurrences or not occurrences[0]: return []
+        signature = self.signature(literals)
+        res = []
+        for clause2 in occurrences[0]:
+            if clause2 is clause: continue
+            literals2, signature2 = self._entry(clause2)
+            if signature & ~signature2: continue
+            if literals <= literals2: res.append(clause2)
+        return res
+
+    # adds a clause unless it is subsumed, and removes the clauses it subsumes,
+    # returns the removed clauses, or None if the clause was not added
+    def add_subsuming(self, clause):
+        if self.is_subsumed(clause): return None
+        removed = self.subsumed_by(clause)
+        for clause2 in removed: self.remove(clause2)
+        self.add(clause)
+        return removed
+
 TermBool.true = TermBool.new_const('True')
 TermBool.false = TermBool.new_const('False')
 TermBool.invert.out_type = TermBool
@@ -421,29 +786,79 @@ def equals(a,b) -> bool:
     
 equals.notation = lambda a,b: (f"{a} <=> {b}" if isinstance(a, TermBool) else f"{a} = {b}")
 
+# Substitution of terms for variables (or other terms), the results get
+# memoized. A substitution can be extended in place by bind, then it is kept
+# in the triangular form: the new value is resolved by the current
+# substitution, the older values are not rewritten, and the memoized results
+# containing a newly bound variable get updated only when they are used again.
+# So building a substitution out of n equations costs O(n) bindings,
+# and all of them share one memo.
+
 class Substitution:
     def __init__(self, base_dict):
-        self.base_dict = base_dict
+        self.bindings = dict(base_dict)
+        self._base_dict = base_dict
         self.cache = dict(base_dict)
         self.vs = set(base_dict.keys())
         self.var_only = all(v.is_var for v in self.vs)
+        self.vs_mask = 0
+        if self.var_only:
+            for v in self.vs: self.vs_mask |= v.var_mask
+        self.bound_mask = 0 # variables added by bind
+
+    def clone(self):
+        res = Substitution.__new__(Substitution)
+        res.bindings = dict(self.bindings)
+        res._base_dict = self._base_dict
+        res.cache = dict(self.cache)
+        res.vs = set(self.vs)
+        res.var_only = self.var_only
+        res.vs_mask = self.vs_mask
+        res.bound_mask = self.bound_mask
+        return res
+
+    # the fully resolved bindings
+    @property
+    def base_dict(self):
+        if self._base_dict is None:
+            self._base_dict = { v : self[v] for v in self.bindings }
+        return self._base_dict
+
+    def bind(self, v, value):
+        assert self.var_only and v.is_var and v not in self.vs
+        value = self[value]
+        assert not (value.var_mask & v.var_mask), f"{v} occurs in {value}"
+        self.bindings[v] = value
+        self._base_dict = None
+        self.cache[v] = value
+        self.vs.add(v)
+        self.vs_mask |= v.var_mask
+        self.bound_mask |= v.var_mask
+
     def __getitem__(self, term):
         if isinstance(term, Substitution):
-            term.substitute(self)
+            return term.substitute(self)
         elif isinstance(term, ArithPair):
             return ArithPair(self[term.x], self[term.y])
         elif isinstance(term, tuple):
             return tuple(self[x] for x in term)
         res = self.cache.get(term)
         if res is None:
-            if self.var_only and not (term.all_vars & self.vs): res = term
-            else:
-                if term.is_var: res = term
-                else:
-                    args = tuple(self[arg] for arg in term.args)
-                    res = term.f(*args, **term.meta_args)
+            res = self._apply(term)
+            self.cache[term] = res
+        elif self.bound_mask and res.var_mask & self.bound_mask:
+            # memoized before some of its variables got bound
+            res = self._apply(term) if res is term else self[res]
             self.cache[term] = res
         return res
+
+    def _apply(self, term):
+        if self.var_only and not (term.var_mask & self.vs_mask): return term
+        elif term.is_var: return term
+        else:
+            args = tuple(self[arg] for arg in term.args)
+            return term.f(*args, **term.meta_args)
+
     def substitute(self, subst):
         if not isinstance(subst, Substitution):
             subst = Substitution(subst)
@@ -462,8 +877,10 @@ class Substitution:
             print(f"{v} -> {value}")
 
 class TermInt(Term):
+    __slots__ = ('const', 'muls', 'summands')
+
     def __init__(self, *args, **kwargs):
-        if self.initialized: return
+        if self._initialized: return
         super().__init__(*args, **kwargs)
         if self.f == TermInt._mk:
             self.const = self.meta_args['const']
@@ -604,8 +1021,10 @@ TermInt.le.notation = lambda x,y: f"{x} <= {y}"
 TermBool.as_int.fget.out_type = TermInt
 
 class TermSequence(Term):
+    __slots__ = ('parts', 'subsequences')
+
     def __init__(self, *args, **kwargs):
-        if self.initialized: return
+        if self._initialized: return
         super().__init__(*args, **kwargs)
         if self.f == type(self).concat:
             self.parts = self.args
@@ -679,6 +1098,8 @@ class TermSequence(Term):
         return self.getitem(self, n)
 
 class MineField(TermSequence, default = TermBool.false):
+    __slots__ = ()
+
     @property
     @term_fun
     def count(self) -> TermInt:
@@ -705,23 +1126,10 @@ class MineField(TermSequence, default = TermBool.false):
     def getitem(self, n) -> TermBool:
         assert isinstance(self, MineField)
         assert isinstance(n, TermInt)
-        if self.f == MineField.concat:
-            options = []
-            for arg in self.args:
-                if isinstance(arg, MineField):
-                    options.append(arg[n])
-                    n = n - arg.length
-                elif isinstance(arg, TermBool):
-                    options.append(arg & equals(n, 0))
-                    n = n - 1
-                else:
-                    raise Exception(f"Unexpected arg type {type(arg)}: {arg}")
-            return disjunction(*options)
-        elif self.f == Jump.to_empty_minefield.fget:
+        if self.f == Jump.to_empty_minefield.fget:
             return TermBool.false
         elif self.f == MineField.empty_copy.fget:
-            [arg] = self.args
-            return arg.length
+            return TermBool.false
         elif (n < 0).guaranteed:
             return TermBool.false
         else:
@@ -758,9 +1166,27 @@ class MineField(TermSequence, default = TermBool.false):
             return None
 
 MineField.getitem.notation = lambda s,n: f"{n} in {s}"
+
+# expanded only in the normal form, see RewriteRules
+@rewrite_rules.rule(MineField.getitem)
+def _getitem_concat(term):
+    mines, n = term.args
+    if mines.f != MineField.concat: return None
+    options = []
+    for arg in mines.args:
+        if isinstance(arg, MineField):
+            options.append(arg[n])
+            n = n - arg.length
+        elif isinstance(arg, TermBool):
+            options.append(arg & equals(n, 0))
+            n = n - 1
+        else:
+            raise Exception(f"Unexpected arg type {type(arg)}: {arg}")
+    return disjunction(*options)
 MineField.empty_copy.fget.out_type = MineField
 
 class Jump(Term): # positive integer
+    __slots__ = ()
 
     @staticmethod
     def mk(n):
@@ -801,8 +1227,10 @@ Jump._mk.out_type = Jump
 Jump._mk.notation = lambda length: f"({length})"
 
 class JumpSet(Term):
+    __slots__ = ('merge_args',)
+
     def __init__(self, *args, **kwargs):
-        if self.initialized: return
+        if self._initialized: return
         super().__init__(*args, **kwargs)
         if self.f == JumpSet.merge:
             self.merge_args = self.args
@@ -903,14 +1331,7 @@ class JumpSet(Term):
     def _contains(self, jump) -> TermBool:
         assert isinstance(self, JumpSet)
         assert isinstance(jump, Jump)
-        if self.f != JumpSet.merge: return None
-        options = []
-        for arg in self.args:
-            if isinstance(arg, Jump):
-                options.append(equals(jump.length, arg.length))
-            else:
-                options.append(arg.contains(jump))
-        return disjunction(*options)
+        return None # expanded only in the normal form, see _contains_merge
 
     def contains(self, jump):
         return self._contains(self, jump)
@@ -963,9 +1384,23 @@ class JumpSet(Term):
 JumpSet.merge.out_type = JumpSet
 JumpSet.merge.notation = JumpSet.merge_notation
 JumpSet._contains.notation = lambda s,j: f"{j} in {s}"
+
+@rewrite_rules.rule(JumpSet._contains)
+def _contains_merge(term):
+    jump_set, jump = term.args
+    if jump_set.f != JumpSet.merge: return None
+    options = []
+    for arg in jump_set.args:
+        if isinstance(arg, Jump):
+            options.append(equals(jump.length, arg.length))
+        else:
+            options.append(arg.contains(jump))
+    return disjunction(*options)
 JumpSet.subtract.out_type = JumpSet
 
 class Jumps(TermSequence, default = Jump(1)):
+    __slots__ = ()
+
     @property
     @term_fun
     def landings(self) -> MineField:
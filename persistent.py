@@ -0,0 +1,173 @@
+# Immutable collections sharing structure among their versions,
+# so that copying is O(1) and a modified copy costs only the difference.
+
+# List extended at the end, versions share the common prefix (a reversed cons-list).
+
+class PersistentList:
+    def __init__(self, items = ()):
+        if isinstance(items, PersistentList):
+            self._last = items._last
+            self._len = items._len
+        else:
+            self._last = None # (previous node, item)
+            self._len = 0
+            for item in items:
+                self._last = (self._last, item)
+                self._len += 1
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        items = []
+        node = self._last
+        while node is not None:
+            node, item = node
+            items.append(item)
+        return reversed(items)
+
+    def append(self, item):
+        res = PersistentList()
+        res._last = (self._last, item)
+        res._len = self._len + 1
+        return res
+
+    def extend(self, items):
+        res = PersistentList(self)
+        for item in items:
+            res._last = (res._last, item)
+            res._len += 1
+        return res
+
+    def __repr__(self):
+        return f"PersistentList({list(self)})"
+
+# Hash map as a hash array mapped trie: 32-way nodes indexed by 5 bits
+# of the hash, an update copies only the nodes on the path to the key.
+# Nodes are lists, leaves are tuples (key, seq, value), keys with a fully equal
+# hash share a dict. Iteration follows the insertion order (seq) as dict does.
+
+class PersistentMap:
+    _mask = (1 << 64) - 1
+
+    def __init__(self, items = ()):
+        if isinstance(items, PersistentMap):
+            self._root = items._root
+            self._len = items._len
+            self._next_seq = items._next_seq
+        else:
+            self._root = None
+            self._len = 0
+            self._next_seq = 0
+            if isinstance(items, dict): items = items.items()
+            for key, value in items:
+                self._set_inplace(key, value)
+
+    @classmethod
+    def _hash(cls, key):
+        return hash(key) & cls._mask
+
+    def _find(self, key):
+        h = self._hash(key)
+        node = self._root
+        shift = 0
+        while isinstance(node, list):
+            node = node[(h >> shift) & 31]
+            shift += 5
+        if isinstance(node, dict): return node.get(key)
+        elif node is not None and node[0] == key: return node
+        else: return None
+
+    def __len__(self):
+        return self._len
+    def __contains__(self, key):
+        return self._find(key) is not None
+    def __getitem__(self, key):
+        leaf = self._find(key)
+        if leaf is None: raise KeyError(key)
+        return leaf[2]
+    def get(self, key, default = None):
+        leaf = self._find(key)
+        if leaf is None: return default
+        return leaf[2]
+
+    def _leaves(self):
+        res = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None: continue
+            elif isinstance(node, list): stack.extend(node)
+            elif isinstance(node, dict): res.extend(node.values())
+            else: res.append(node)
+        res.sort(key = lambda leaf: leaf[1])
+        return res
+
+    def items(self):
+        return [(key, value) for key, _, value in self._leaves()]
+    def keys(self):
+        return [key for key, _, _ in self._leaves()]
+    def values(self):
+        return [value for _, _, value in self._leaves()]
+    def __iter__(self):
+        return iter(self.keys())
+
+    def _assoc(self, node, shift, h, leaf):
+        if node is None: return leaf
+        elif isinstance(node, dict):
+            node = dict(node)
+            node[leaf[0]] = leaf
+            return node
+        elif isinstance(node, tuple):
+            if node[0] == leaf[0]: return leaf
+            if shift >= 64: return { node[0] : node, leaf[0] : leaf }
+            split = [None]*32
+            split[(self._hash(node[0]) >> shift) & 31] = node
+            return self._assoc(split, shift, h, leaf)
+        else:
+            i = (h >> shift) & 31
+            node = list(node)
+            node[i] = self._assoc(node[i], shift+5, h, leaf)
+            return node
+
+    def _dissoc(self, node, shift, h, key):
+        if isinstance(node, dict):
+            node = dict(node)
+            del node[key]
+            if len(node) == 1: [node] = node.values()
+            return node
+        elif isinstance(node, tuple):
+            return None
+        else:
+            i = (h >> shift) & 31
+            node = list(node)
+            node[i] = self._dissoc(node[i], shift+5, h, key)
+            if all(x is None for x in node): return None
+            return node
+
+    def _set_inplace(self, key, value):
+        old = self._find(key)
+        if old is None:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._len += 1
+        else:
+            seq = old[1]
+        self._root = self._assoc(self._root, 0, self._hash(key), (key, seq, value))
+
+    # returns an updated copy
+    def set(self, key, value):
+        res = PersistentMap(self)
+        res._set_inplace(key, value)
+        return res
+
+    # returns a copy without the key
+    def delete(self, key):
+        if key not in self: raise KeyError(key)
+        res = PersistentMap(self)
+        res._root = self._dissoc(self._root, 0, self._hash(key), key)
+        res._len -= 1
+        return res
+
+    def __repr__(self):
+        return f"PersistentMap({dict(self.items())})"
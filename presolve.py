@@ -0,0 +1,201 @@
+from logic import equals, conjunction, disjunction, TermBool, TermInt
+
+# Lightweight refutation of LIA constraints in the process, before a solver
+# gets spawned:
+# * unit propagation over the clauses (disjunctions of literals),
+# * propagation of integer bounds of the atoms through the linear
+#   inequalities that became units,
+# * negative cycles among the difference constraints (x - y <= c).
+# Anything it does not understand stays unconstrained, so it only relaxes
+# the problem, and a contradiction is a real one. The unsat core
+# consists of all the constraints that derived something.
+
+class BoundPropagation:
+    def __init__(self, constraints, max_rounds = 50, max_cycle_work = 10**6):
+        self.constraints = constraints
+        self.max_rounds = max_rounds
+        self.max_cycle_work = max_cycle_work
+        self.bools = dict() # bool atom -> True / False
+        self.lower = dict() # int atom -> int
+        self.upper = dict()
+        self.units = [] # (linear term, constraint index), meaning: term <= 0
+        self.used = set() # indices of constraints used in the derivation
+
+    ########   Evaluation under the current bounds
+
+    def interval(self, term, skip = None):
+        lo = hi = term.const
+        for x, c in zip(term.summands, term.muls):
+            if x is skip: continue
+            l = self.lower.get(x)
+            u = self.upper.get(x)
+            if c < 0: l, u = u, l
+            lo = None if lo is None or l is None else lo + c*l
+            hi = None if hi is None or u is None else hi + c*u
+        return lo, hi
+
+    # returns True / False, or None if unknown
+    def value(self, prop):
+        if prop == TermBool.true: return True
+        elif prop == TermBool.false: return False
+        elif prop.f == TermBool.invert:
+            value = self.value(prop.args[0])
+            return None if value is None else not value
+        elif prop.f == TermInt.le:
+            lo, hi = self.interval(prop.args[0] - prop.args[1])
+            if hi is not None and hi <= 0: return True
+            if lo is not None and lo > 0: return False
+            return None
+        elif prop.f == equals and isinstance(prop.args[0], TermInt):
+            lo, hi = self.interval(prop.args[0] - prop.args[1])
+            if lo == 0 and hi == 0: return True
+            if (lo is not None and lo > 0) or (hi is not None and hi < 0): return False
+            return None
+        elif prop.f == equals and isinstance(prop.args[0], TermBool):
+            a, b = (self.value(arg) for arg in prop.args)
+            if a is None or b is None: return None
+            return a == b
+        elif prop.f in (conjunction, disjunction):
+            neutral = (prop.f == conjunction)
+            values = [self.value(arg) for arg in prop.args]
+            if (not neutral) in values: return not neutral
+            if None in values: return None
+            return neutral
+        else:
+            return self.bools.get(prop)
+
+    ########   Assertions, returning False on a conflict
+
+    def assert_bool(self, atom, value):
+        known = self.bools.setdefault(atom, value)
+        return known == value
+
+    def assert_literal(self, prop, i):
+        if prop == TermBool.false: return False
+        elif prop == TermBool.true: return True
+        elif prop.f == conjunction:
+            return all(self.assert_literal(arg, i) for arg in prop.args)
+        elif prop.f == TermBool.invert:
+            arg = prop.args[0]
+            if arg.f == TermInt.le:
+                a, b = arg.args
+                self.units.append((b - a + 1, i))
+                return True
+            elif self._is_bool_atom(arg):
+                return self.assert_bool(arg, False)
+            else: return True
+        elif prop.f == TermInt.le:
+            a, b = prop.args
+            self.units.append((a - b, i))
+            return True
+        elif prop.f == equals and isinstance(prop.args[0], TermInt):
+            a, b = prop.args
+            self.units.append((a - b, i))
+            self.units.append((b - a, i))
+            return True
+        elif self._is_bool_atom(prop):
+            return self.assert_bool(prop, True)
+        else:
+            return True
+
+    # as LiaChecker._has_bool_op and _has_int_op
+    @staticmethod
+    def _is_bool_atom(prop):
+        if prop.f == equals: return not isinstance(prop.args[0], (TermBool, TermInt))
+        return prop.f not in (TermInt.le, TermBool.invert, conjunction, disjunction)
+
+    ########   Propagation
+
+    # tightens the bounds by the unit term <= 0, returns None on a conflict,
+    # otherwise whether something changed
+    def propagate_unit(self, term):
+        changed = False
+        for x, c in zip(term.summands, term.muls):
+            lo_rest, _ = self.interval(term, skip = x)
+            if lo_rest is None: continue
+            rest = -lo_rest # c*x <= rest
+            if c > 0:
+                bound = rest // c
+                if x not in self.upper or bound < self.upper[x]:
+                    self.upper[x] = bound
+                    changed = True
+            else:
+                bound = -(rest // -c)
+                if x not in self.lower or bound > self.lower[x]:
+                    self.lower[x] = bound
+                    changed = True
+            if x in self.lower and x in self.upper and self.lower[x] > self.upper[x]:
+                return None
+        return changed
+
+    def negative_cycle(self):
+        zero = None # the node of the constant zero
+        edges = [] # (u, v, w): v - u <= w
+        for term, i in self.units:
+            terms = list(zip(term.summands, term.muls))
+            if len(terms) == 1 and abs(terms[0][1]) == 1:
+                [(x, c)] = terms
+                if c == 1: edges.append((zero, x, -term.const, i))
+                else: edges.append((x, zero, -term.const, i))
+            elif len(terms) == 2 and sorted(c for _, c in terms) == [-1, 1]:
+                (x, cx), (y, cy) = terms
+                if cx == -1: x, y = y, x
+                edges.append((y, x, -term.const, i))
+        nodes = set(u for u, _, _, _ in edges) | set(v for _, v, _, _ in edges)
+        if not edges or len(nodes) * len(edges) > self.max_cycle_work: return False
+        dist = dict.fromkeys(nodes, 0)
+        for _ in range(len(nodes)):
+            changed = False
+            for u, v, w, _ in edges:
+                if dist[u] + w < dist[v]:
+                    dist[v] = dist[u] + w
+                    changed = True
+            if not changed: return False
+        self.used.update(i for _, _, _, i in edges)
+        return True
+
+    # returns True if a contradiction was found
+    def refute(self):
+        open_clauses = list(enumerate(self.constraints))
+        for _ in range(self.max_rounds):
+            changed = False
+            remaining = []
+            for i, constraint in open_clauses:
+                unknown = []
+                satisfied = False
+                for literal in constraint.disj_args:
+                    value = self.value(literal)
+                    if value is None: unknown.append(literal)
+                    elif value:
+                        satisfied = True
+                        break
+                if satisfied: continue
+                if len(unknown) > 1:
+                    remaining.append((i, constraint))
+                    continue
+                self.used.add(i)
+                changed = True
+                if not unknown or not self.assert_literal(unknown[0], i):
+                    return True
+            open_clauses = remaining
+
+            for term, i in self.units:
+                unit_changed = self.propagate_unit(term)
+                if unit_changed is None:
+                    self.used.add(i)
+                    return True
+                if unit_changed:
+                    self.used.add(i)
+                    changed = True
+            if not changed: break
+
+        return self.negative_cycle()
+
+# decides the lia as unsatisfiable without a solver if the propagation
+# finds a contradiction, returns whether it did
+def presolve(lia):
+    propagation = BoundPropagation(lia.constraints)
+    if not propagation.refute(): return False
+    lia.reset_outcome()
+    lia.set_unsat_core(sorted(propagation.used))
+    return True
@@ -1,11 +1,33 @@
-from logic import equals, Substitution, TermBool, TermInt, Jump, Jumps, MineField, JumpSet, FREE_VAR
-from auto_inst import AutoInstance
-from smt_lia import LiaChecker
+import itertools
+import multiprocessing
+import os
+from collections import defaultdict
+
+from logic import equals, conjunction, normal_form, Substitution, SubsumptionIndex, TermBool, TermInt, Jump, Jumps, MineField, JumpSet, FREE_VAR
+from auto_inst import AutoInstance, TermIndex
+from presolve import presolve
+from smt_lia import LiaChecker, SmtSession, SolverPortfolio, no_limits
 from uflia_hammer import record_grasshopper_task
 import export_to_lean
 
 debug = False
+presolving = True # try to refute the constraints by presolve.BoundPropagation first
 default_solver = ('cvc4', '-m', '--lang', 'smt')
+default_session_solver = ('cvc4', '-m', '-i', '--lang', 'smt')
+portfolio_solvers = (
+    ('z3', '-in', '-smt2'),
+    ('cvc4', '-m', '--lang', 'smt'),
+    ('cvc5', '-m', '--lang', 'smt'),
+)
+
+# the command of an incremental solver (for SmtSession) running as solver_cmd
+def session_solver(solver_cmd):
+    if isinstance(solver_cmd, SolverPortfolio): return solver_cmd # rejected by SmtSession
+    if solver_cmd == default_solver: return default_session_solver
+    name = os.path.basename(solver_cmd[0])
+    if name in ('cvc4', 'cvc5') and not ({'-i', '--incremental'} & set(solver_cmd)):
+        return (solver_cmd[0], '-i') + tuple(solver_cmd[1:])
+    return tuple(solver_cmd)
 
 class ProvenTrivially:
     pass
@@ -33,12 +55,34 @@ class FailedProof(Exception):
     def __str__(self):
         return "Proof Failed!\n"+self.model_str()
 
+# the solver gave up (timeout, memout, incomplete), nothing is known
+class SolverUnknown(FailedProof):
+    def __init__(self, reason):
+        self.model = None
+        self.reason = reason
+
+    def __str__(self):
+        return f"Proof Failed! Solver gave up: {self.reason}"
+
 # looks for oriented equations "a = f(b,c)"
 # and tries to transform them into a substitution
-
-def extract_subst(constraints):
+# base: optional CompiledFacts of a prefix of the constraints,
+#       the extraction continues from its substitution
+
+def extract_subst(constraints, base = None):
+    if base is not None and base.substitute:
+        n = len(base.facts)
+        assert all(a is b for a,b in zip(constraints[:n], base.facts))
+        return base.extract_subst(constraints[n:])
     res = []
     subst = Substitution({})
+    extend_subst(constraints, res, subst)
+    res = [subst[constraint] for constraint in res]
+    return res, subst
+
+# the loop of extract_subst, binds the oriented equations in subst in place,
+# and appends the other constraints to res (not substituted yet)
+def extend_subst(constraints, res, subst):
     for constraint in constraints:
         if constraint.f != equals or not constraint.args[0].is_var:
             res.append(constraint)
@@ -48,9 +92,10 @@ def extract_subst(constraints):
             res.append(constraint)
             continue
         lhs,rhs = constraint.args
-        subst = subst.substitute({lhs : rhs})
-    res = [subst[constraint] for constraint in res]
-    return res, subst    
+        if rhs.var_mask & lhs.var_mask: # not a definition of lhs
+            res.append(constraint)
+            continue
+        subst.bind(lhs, rhs)
 
 # automatically closes assumptions of the form (X = ...) where X is free
 def simplify_clause(clause, can_eliminate = lambda x: x.var_type == FREE_VAR):
@@ -74,44 +119,216 @@ def simplify_exist_clause(clause, *args, **kwargs):
 
 # splits constraints into lists of ground terms, and quantified AutoInstances 
 
+# clauses subsumed by other clauses (also from other constraints) are dropped
+
 def separate_ground(constraints):
-    ground = []
-    quantified = []
+    clauses = []
+    index = SubsumptionIndex()
+    definition_atoms = dict() # see logic.Clausifier
 
     for constraint in constraints:
+        constraint = normal_form(constraint)
         if not any(v.is_free_var for v in constraint.all_vars):
-            if debug: print(constraint)
-            ground.append(constraint)
+            cur_clauses = [constraint]
         else:
-            constraint = constraint.clausify()
-            for clause in constraint.conj_args:
-                # try to simplify a dis-equality
-                clause = simplify_clause(clause)
-                if any(x.is_free_var for x in clause.all_vars):
-                    quantified.append(AutoInstance(clause))
-                else:
-                    if debug: print(clause)
-                    ground.append(clause)
+            # try to simplify a dis-equality
+            cur_clauses = [
+                simplify_clause(clause)
+                for clause in constraint.clausify(definition_atoms).conj_args
+            ]
+        for clause in cur_clauses:
+            if index.add_subsuming(clause) is not None:
+                clauses.append(clause)
+
+    ground = []
+    quantified = []
+    for clause in clauses:
+        if clause not in index: continue
+        if any(x.is_free_var for x in clause.all_vars):
+            quantified.append(AutoInstance(clause))
+        else:
+            if debug: print(clause)
+            ground.append(clause)
 
     return ground, quantified
 
+# adds a ground clause together with the definitions of the definition atoms
+# it contains, the clausification could introduce them, see logic.Clausifier,
+# returns the list of added constraints
+
+def add_ground_clause(lia, clause):
+    added = []
+    stack = [clause]
+    while stack:
+        clause = normal_form(stack.pop())
+        if clause in lia.constraints_s or clause == TermBool.true: continue
+        lia.add_constraint(clause)
+        added.append(clause)
+        for atom in clause.atoms():
+            if atom.is_definition: stack.extend(atom.unfold_definition())
+    return added
+
 # adds instances of quantified formulas to match the ground terms from lia
 
 def add_instances(lia, quantified, max_inst_iters):
     iteration = 0
-    bool_i = 0
-    int_i = 0
+    start = 0
+    # instances subsumed by the present ground clauses are skipped
+    index = SubsumptionIndex()
+    for constraint in lia.constraints:
+        index.add(constraint)
     while iteration < max_inst_iters:
-        cur_terms = lia.bool_vars[bool_i:] + lia.int_vars[int_i:]
-        bool_i = len(lia.bool_vars)
-        int_i = len(lia.int_vars)
-        if not cur_terms: break
+        end = len(lia.term_index)
+        if start == end: break
         for constraint in quantified:
-            for ground_constraint in constraint.get_instances(cur_terms):
+            for ground_constraint in constraint.get_instances(lia.term_index, start, end):
+                if index.is_subsumed(ground_constraint): continue
+                index.add(ground_constraint)
                 if debug: print(ground_constraint)
-                lia.add_constraint(ground_constraint)
+                add_ground_clause(lia, ground_constraint)
+        start = end
         iteration += 1
 
+# Compiled state of a growing list of facts, as constraints_to_lia
+# would produce it with a single instantiation round: the substitution
+# from the directed equations, the quantified AutoInstances, and a LiaChecker
+# with the ground clauses and the instances. Adding a fact costs its clauses
+# and their instances only. A fact extending the substitution changes
+# all the other facts, then the state gets rebuilt on the next use.
+# The facts of a goal go to a layer over the shared state (see layer),
+# which still copies the lists of facts and of the LIA problem,
+# the congruence theorems are computed over all the atoms again.
+
+class CompiledFacts:
+    def __init__(self, facts = (), substitute = True):
+        self.substitute = substitute
+        self.facts = list(facts)
+        self._rebuild()
+
+    def _rebuild(self):
+        self.stale = False
+        self.trivial = TermBool.false in self.facts
+        self.residual = [] # facts not turned into the substitution
+        self.subst = Substitution({})
+        if self.substitute:
+            extend_subst(self.facts, self.residual, self.subst)
+        else:
+            self.residual.extend(self.facts)
+        constraints = [self.subst[constraint] for constraint in self.residual]
+        self.lia = LiaChecker()
+        self.quantified = []
+        self.clauses = SubsumptionIndex() # both quantified and ground
+        self.ground_terms = TermIndex() # atoms of the ground clauses, for matching
+        self.definition_atoms = dict() # see logic.Clausifier
+        for constraint in constraints:
+            self._add_substituted(constraint)
+
+    # rebuilds the state if a fact extended the substitution
+    def refresh(self):
+        if self.stale: self._rebuild()
+
+    # a CompiledFacts extending this one, sharing its clause and atom indexes
+    # as their layers, this one must not get new facts while it is in use
+    def layer(self):
+        res = CompiledFacts.__new__(CompiledFacts)
+        res.substitute = self.substitute
+        res.facts = list(self.facts)
+        res.stale = self.stale
+        res.trivial = self.trivial
+        res.residual = list(self.residual)
+        res.subst = self.subst
+        res.lia = self.lia.clone()
+        res.quantified = list(self.quantified)
+        res.clauses = self.clauses.layer()
+        res.ground_terms = self.ground_terms.layer()
+        res.definition_atoms = dict(self.definition_atoms)
+        return res
+
+    def add_fact(self, fact):
+        self.facts.append(fact)
+        if fact == TermBool.false: self.trivial = True
+        if self.stale: return
+        constraint = self.subst[fact] if self.substitute else fact
+        directed = lambda x: x.f == equals and x.args[0].is_var # as in extend_subst
+        if self.substitute and directed(fact) and directed(constraint):
+            lhs, rhs = constraint.args
+            if not (rhs.var_mask & lhs.var_mask):
+                self.stale = True
+                return
+        self.residual.append(constraint if directed(fact) else fact)
+        self._add_substituted(constraint)
+
+    # extract_subst of the facts extended by constraints, the substitution
+    # of the facts is shared, or copied if it gets extended
+    def extract_subst(self, constraints = ()):
+        self.refresh()
+        res = list(self.residual)
+        subst = self.subst
+        if constraints:
+            subst = subst.clone()
+            extend_subst(constraints, res, subst)
+        return [subst[constraint] for constraint in res], subst
+
+    def add_ground_term(self, term):
+        self.refresh()
+        term = normal_form(term)
+        start = len(self.ground_terms)
+        for atom in self.lia.atoms_iter(term):
+            if atom not in self.ground_terms: self.ground_terms.add(atom)
+        self.lia.add_term(term)
+        self._instantiate(self.quantified, start)
+
+    def _add_substituted(self, constraint):
+        constraint = normal_form(constraint)
+        if not any(v.is_free_var for v in constraint.all_vars):
+            clauses = [constraint]
+        else:
+            clauses = [
+                simplify_clause(clause)
+                for clause in constraint.clausify(self.definition_atoms).conj_args
+            ]
+        for clause in clauses:
+            removed = self.clauses.add_subsuming(clause)
+            if removed is None: continue
+            if removed:
+                removed = set(removed)
+                self.quantified = [x for x in self.quantified if x.generic not in removed]
+            if any(x.is_free_var for x in clause.all_vars):
+                auto_instance = AutoInstance(clause)
+                self.quantified.append(auto_instance)
+                self._instantiate([auto_instance], 0)
+            else:
+                start = len(self.ground_terms)
+                for added in add_ground_clause(self.lia, clause):
+                    for atom in self.lia.atoms_iter(added):
+                        if atom not in self.ground_terms: self.ground_terms.add(atom)
+                self._instantiate(self.quantified, start)
+
+    # matches the ground terms from the position start
+    def _instantiate(self, quantified, start):
+        end = len(self.ground_terms)
+        if start == end: return
+        for constraint in quantified:
+            for ground_constraint in constraint.get_instances(self.ground_terms, start, end):
+                if self.clauses.is_subsumed(ground_constraint): continue
+                self.clauses.add(ground_constraint)
+                add_ground_clause(self.lia, ground_constraint)
+
+    # the LiaChecker for the facts extended by constraints
+    def to_lia(self, constraints = (), extra_terms = (), congruence = True):
+        self.refresh()
+        compiled = self.layer()
+        for constraint in constraints:
+            compiled.add_fact(constraint)
+        for term in extra_terms:
+            compiled.add_ground_term(term)
+        if compiled.stale: compiled._rebuild()
+        if compiled.trivial: return ProvenTrivially()
+        lia = compiled.lia
+        if congruence:
+            lia.add_congruence_theorems()
+        return lia
+
 # tries to prove a contradiction from the given list of terms
 # (1) it looks for rewriting rules for fixed variables a = f(b,c),
 #     and transforms them into a substitution applied to all the constraints
@@ -121,7 +338,15 @@ def add_instances(lia, quantified, max_inst_iters):
 # (4) in a few iterations, adds extra instances of clauses with free variables
 #     that match the ground constraints
 
-def constraints_to_lia(constraints, extra_terms = (), substitute = True, max_inst_iters = 1, congruence = True):
+# base: optional CompiledFacts of a prefix of the constraints, it is extended
+#       by the remaining ones instead of processing everything again
+
+def constraints_to_lia(constraints, extra_terms = (), substitute = True, max_inst_iters = 1, congruence = True, base = None):
+
+    if base is not None and max_inst_iters == 1 and base.substitute == substitute:
+        n = len(base.facts)
+        assert all(a is b for a,b in zip(constraints[:n], base.facts))
+        return base.to_lia(constraints[n:], extra_terms, congruence)
 
     if debug:
         print("\nConstraints:\n")
@@ -150,9 +375,9 @@ def constraints_to_lia(constraints, extra_terms = (), substitute = True, max_ins
     ground, quantified = separate_ground(constraints2)
     lia = LiaChecker()
     for constraint in ground:
-        lia.add_constraint(constraint)
+        add_ground_clause(lia, constraint)
     for term in extra_terms:
-        lia.add_term(term)
+        lia.add_term(normal_form(term))
 
     if debug:
         print("\nSubstituted, quantified:\n")
@@ -173,21 +398,42 @@ def constraints_to_lia(constraints, extra_terms = (), substitute = True, max_ins
 
     return lia
 
+# runs the solver either as a new process, or in a running SmtSession,
+# solver_cmd can be also a SolverPortfolio
+def solve_lia(lia, solver_cmd = default_solver, session = None, cache = None, limits = no_limits):
+    if presolving and presolve(lia): return
+    if session is not None: session.solve(lia)
+    elif isinstance(solver_cmd, SolverPortfolio): solver_cmd.solve(lia, cache)
+    else: lia.solve(solver_cmd, cache, limits)
+
 last_problem_index = -1
 
-def prove_contradiction(constraints, record_uflia = False, record_lean = False, show_step = False, solver_cmd = default_solver, **kwargs):
-    global last_problem_index
-    lia = constraints_to_lia(constraints, **kwargs)
+# core_index: optional UnsatCoreIndex, skips the solver if a known core is contained
+def use_known_core(lia, core_index):
+    if core_index is None: return False
+    core = core_index.find(lia.constraints)
+    if core is None: return False
+    lia.set_unsat_core([
+        i for i, constraint in enumerate(lia.constraints)
+        if constraint in core
+    ])
+    return True
 
-    if isinstance(lia, ProvenTrivially): return
-    lia.solve(solver_cmd)
+# raises FailedProof if the solver didn't find a contradiction,
+# otherwise records the problem
+def finish_proof(lia, constraints, core_index = None, record_uflia = False, record_lean = False, show_step = False, base = None):
+    global last_problem_index
 
     if not lia.unsatisfiable:
-        if lia.satisfiable:
-            _, subst = extract_subst(constraints)
+        if lia.unknown:
+            raise SolverUnknown(lia.unknown_reason)
+        elif lia.satisfiable:
+            _, subst = extract_subst(constraints, base)
             raise FailedProof(subst.substitute(lia.sat_model))
         else:
             raise FailedProof(None)
+    if core_index is not None:
+        core_index.add(lia.unsat_core)
 
     # record as a problem
     last_problem_index += 1
@@ -199,19 +445,157 @@ def prove_contradiction(constraints, record_uflia = False, record_lean = False,
     if record_lean:
         export_to_lean.export_problem(constraints, last_problem_index)
 
-# the list optional_constraints gets reduced to a satisfiable beginning
-def get_model(hard_constraints, optional_constraints, extra_terms = (), solver_cmd = default_solver, **kwargs):
+def prove_contradiction(constraints, record_uflia = False, record_lean = False, show_step = False, solver_cmd = default_solver, session = None, cache = None, core_index = None, limits = no_limits, **kwargs):
+    lia = constraints_to_lia(constraints, **kwargs)
 
-    hard_constraints, subst = extract_subst(hard_constraints)
-    optional_constraints_ori = list(optional_constraints)
+    if isinstance(lia, ProvenTrivially): return
+    if not use_known_core(lia, core_index):
+        solve_lia(lia, solver_cmd, session, cache, limits)
+    finish_proof(lia, constraints, core_index, record_uflia, record_lean, show_step, kwargs.get('base'))
+
+# Cone of influence of the last num_goals constraints: the constraints
+# connected to them through shared fixed variables (within depth steps if set),
+# and the constraints without fixed variables (the universal theorems).
+# The order is kept.
+
+def relevant_constraints(constraints, num_goals = 1, depth = None):
+    constraints = list(constraints)
+    fixed_vars = [
+        [v for v in constraint.all_vars if v.is_fixed_var]
+        for constraint in constraints
+    ]
+    var_to_constraints = defaultdict(list)
+    for i, vs in enumerate(fixed_vars):
+        for v in vs: var_to_constraints[v].append(i)
+    relevant = set(range(len(constraints) - num_goals, len(constraints)))
+    layer = list(relevant)
+    reached = set()
+    while layer and depth != 0:
+        next_layer = []
+        for i in layer:
+            for v in fixed_vars[i]:
+                if v in reached: continue
+                reached.add(v)
+                for j in var_to_constraints[v]:
+                    if j in relevant: continue
+                    relevant.add(j)
+                    next_layer.append(j)
+        layer = next_layer
+        if depth is not None: depth -= 1
+    return [
+        constraint
+        for i, constraint in enumerate(constraints)
+        if i in relevant or not fixed_vars[i]
+    ]
 
+# tries prove_contradiction on the relevant constraints only,
+# and on all of them if it fails (the base is used only then)
+def prove_contradiction_sliced(constraints, num_goals = 1, depth = None, base = None, **kwargs):
+    sliced = relevant_constraints(constraints, num_goals, depth)
+    if len(sliced) < len(constraints):
+        try:
+            prove_contradiction(sliced, **kwargs)
+            return
+        except FailedProof:
+            pass
+    prove_contradiction(constraints, base = base, **kwargs)
+
+# the same as prove_contradiction, awaiting the solver
+# (it runs as a new process, solver sessions are not shared among coroutines)
+async def prove_contradiction_async(constraints, record_uflia = False, record_lean = False, show_step = False, solver_cmd = default_solver, cache = None, core_index = None, limits = no_limits, **kwargs):
+    lia = constraints_to_lia(constraints, **kwargs)
+
+    if isinstance(lia, ProvenTrivially): return
+    if not use_known_core(lia, core_index) and not (presolving and presolve(lia)):
+        await lia.solve_async(solver_cmd, cache = cache, limits = limits)
+    finish_proof(lia, constraints, core_index, record_uflia, record_lean, show_step, kwargs.get('base'))
+
+# Jobs of the worker processes in prove_in_pool. The workers are forked,
+# so they inherit the jobs, terms cannot be sent between processes
+# since they are compared by identity. For the same reason, a pool can
+# serve only the jobs known when it was forked, and it is not reused.
+_pool_jobs = None
+
+def _pool_prove(i):
+    constraints, base, kwargs = _pool_jobs[i]
+    try:
+        prove_contradiction(constraints, base = base, **kwargs)
+    except SolverUnknown as e:
+        return e.reason
+    except FailedProof:
+        return "failed"
+    return None
+
+# checks the jobs (lists of constraints) in a pool of processes,
+# returns a list with None for every contradictory job, and a reason of the failure
+# otherwise, in the order of jobs. A solver session cannot be shared with the workers.
+# bases: optional CompiledFacts of the jobs (see constraints_to_lia), compiled
+#   before forking, so that the workers only extend them
+def prove_in_pool(jobs, workers = None, bases = None, **kwargs):
+    global _pool_jobs
+    assert 'session' not in kwargs
+    if bases is None: bases = [None] * len(jobs)
+    for base in bases:
+        if base is not None: base.refresh()
+    _pool_jobs = [(constraints, base, kwargs) for constraints, base in zip(jobs, bases)]
+    try:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            return pool.map(_pool_prove, range(len(jobs)))
+    finally:
+        _pool_jobs = None
+
+# decides a list of cases (each case is a list of props) against shared constraints,
+# the constraints are encoded only once, and every case is guarded by
+# an indicator variable checked by check-sat-assuming
+# returns a list with None for every contradictory case, and FailedProof otherwise
+
+def prove_contradiction_cases(constraints, cases, solver_cmd = default_session_solver, session = None, cache = None, limits = no_limits, **kwargs):
+    if TermBool.false in constraints:
+        return [None for case in cases]
+    indicators = [TermBool.fixed_var(f"case_{i}") for i in range(len(cases))]
+    guarded = [
+        ~indicator | conjunction(*case)
+        for indicator, case in zip(indicators, cases)
+    ]
+    lia = constraints_to_lia(list(constraints) + guarded, extra_terms = indicators, **kwargs)
+    if isinstance(lia, ProvenTrivially):
+        return [None for case in cases]
+
+    own_session = session is None
+    if own_session: session = SmtSession(solver_cmd, cache, limits)
+    _, subst = extract_subst(constraints, kwargs.get('base'))
+    indicators_s = set(indicators)
+    res = []
+    try:
+        for indicator in indicators:
+            session.solve(lia, [indicator])
+            if lia.unsatisfiable:
+                res.append(None)
+            elif lia.satisfiable:
+                model = Substitution({
+                    v : value
+                    for v, value in lia.sat_model.base_dict.items()
+                    if v not in indicators_s
+                })
+                res.append(FailedProof(subst.substitute(model)))
+            elif lia.unknown:
+                res.append(SolverUnknown(lia.unknown_reason))
+            else:
+                res.append(FailedProof(None))
+    finally:
+        if own_session: session.close()
+    return res
+
+# hard constraints of get_model converted to a LiaChecker,
+# with a function completing a model by values of extra_terms
+def model_base(hard_constraints, extra_terms, base = None, **kwargs):
+    hard_constraints, subst = extract_subst(hard_constraints, base)
     lia_base = constraints_to_lia(
         hard_constraints,
         substitute = False,
         extra_terms = [subst[term] for term in extra_terms],
         **kwargs,
     )
-    if isinstance(lia_base, ProvenTrivially): return None
 
     def finish_model(model):
         if extra_terms:
@@ -222,11 +606,63 @@ def get_model(hard_constraints, optional_constraints, extra_terms = (), solver_c
             model = Substitution(enriched_dict)
         return model        
 
+    return lia_base, subst, finish_model
+
+# numerals and true / false, the values of a model
+def is_value(term):
+    if isinstance(term, TermInt): return term.is_num_const
+    else: return term in (TermBool.true, TermBool.false)
+
+# the list optional_constraints gets reduced to a satisfiable subset,
+# constraints are taken greedily in the order of priority
+# A model satisfying all the constraints of the lia (ground facts, instances,
+# congruence) is as good as a new one from the solver, and if it satisfies
+# all the optional constraints too, the greedy search would keep them all.
+# The constraints are evaluated by the model substitution, its cache
+# shares the evaluated subterms among all of them. The model must also
+# give a value to every atom of the lia and every one of the terms
+# (such as the extra terms of get_model), a variable added since
+# the model was found has none.
+def model_satisfies(model, lia, optional_constraints = (), terms = ()):
+    if model is None: return False
+    if not all(
+        is_value(model[term])
+        for term in itertools.chain(lia.int_vars, lia.bool_vars, terms)
+    ): return False
+    return all(
+        model[normal_form(constraint)] == TermBool.true
+        for constraint in itertools.chain(lia.constraints, optional_constraints)
+    )
+
+# candidate: optional model found before, returned without calling the solver
+#   if it still satisfies all the constraints, see model_satisfies
+def get_model(hard_constraints, optional_constraints, extra_terms = (), solver_cmd = default_solver, session = None, cache = None, limits = no_limits, core_guided = True, candidate = None, **kwargs):
+
+    optional_constraints_ori = list(optional_constraints)
+    lia_base, subst, finish_model = model_base(hard_constraints, extra_terms, **kwargs)
+    if isinstance(lia_base, ProvenTrivially): return None
+    if model_satisfies(candidate, lia_base, subst[tuple(optional_constraints)], subst[tuple(extra_terms)]):
+        return finish_model(candidate)
+
+    if core_guided:
+        search = CoreGuidedSearch(lia_base, optional_constraints, subst)
+        own_session = session is None
+        if own_session: session = SmtSession(session_solver(solver_cmd), cache, limits)
+        try:
+            while not search.finished:
+                session.solve(search.lia, search.assumptions)
+                search.update()
+        finally:
+            if own_session: session.close()
+        model = search.result(optional_constraints)
+        if model is None: return None
+        return finish_model(model)
+
     def try_constraints():
         lia = lia_base.clone()
         for constraint in optional_constraints:
-            lia.add_constraint(subst[constraint])
-        lia.solve(solver_cmd)
+            lia.add_constraint(normal_form(subst[constraint]))
+        solve_lia(lia, solver_cmd, session, cache, limits)
         if lia.satisfiable and lia.sat_model is not None:
             return lia.sat_model
         else:
@@ -252,6 +688,98 @@ def get_model(hard_constraints, optional_constraints, extra_terms = (), solver_c
 
     return finish_model(model)
 
+# the same as get_model with core_guided, awaiting the solver
+async def get_model_async(hard_constraints, optional_constraints, extra_terms = (), solver_cmd = default_solver, cache = None, limits = no_limits, candidate = None, **kwargs):
+
+    lia_base, subst, finish_model = model_base(hard_constraints, extra_terms, **kwargs)
+    if isinstance(lia_base, ProvenTrivially): return None
+    if model_satisfies(candidate, lia_base, subst[tuple(optional_constraints)], subst[tuple(extra_terms)]):
+        return finish_model(candidate)
+
+    search = CoreGuidedSearch(lia_base, optional_constraints, subst)
+    while not search.finished:
+        await search.lia.solve_async(solver_cmd, search.assumptions, cache, limits)
+        search.update()
+    model = search.result(optional_constraints)
+    if model is None: return None
+    return finish_model(model)
+
+# Same result as the greedy loop in get_model, but every optional constraint
+# is guarded by an indicator, and checked by check-sat-assuming.
+# If kept + remaining[:upper] is unsatisfiable, the last remaining constraint
+# in the core is the latest point where the greedy choice can fail,
+# so all the constraints before it are either kept together, or the bound
+# gets lowered by the next core.
+# Usage: while not finished, solve lia with assumptions, and call update
+
+class CoreGuidedSearch:
+    def __init__(self, lia_base, optional_constraints, subst):
+        self.lia = lia_base.clone()
+        # trivially true constraints are kept without an indicator,
+        # trivially false ones dropped, indicators[i] is for optional_constraints[positions[i]]
+        self.always = []
+        self.indicators = []
+        self.positions = []
+        for i, constraint in enumerate(optional_constraints):
+            constraint = normal_form(subst[constraint])
+            if constraint == TermBool.true:
+                self.always.append(i)
+                continue
+            if constraint == TermBool.false: continue
+            indicator = TermBool.fixed_var(f"optional_{i}")
+            self.lia.add_constraint(~indicator | constraint)
+            self.indicators.append(indicator)
+            self.positions.append(i)
+        self.indicator_to_i = { indicator : i for i, indicator in enumerate(self.indicators) }
+
+        self.kept = []
+        self.remaining = list(range(len(self.indicators)))
+        self.upper = len(self.remaining)
+        self.model = None
+        self.finished = False
+
+    @property
+    def assumptions(self):
+        return [self.indicators[i] for i in self.kept + self.remaining[:self.upper]]
+
+    def update(self):
+        lia = self.lia
+        if lia.satisfiable and lia.sat_model is not None:
+            self.model = lia.sat_model
+            self.kept.extend(self.remaining[:self.upper])
+            if self.upper == len(self.remaining):
+                self.finished = True
+            else: # remaining[upper] is in conflict with kept
+                self.remaining = self.remaining[self.upper+1:]
+                self.upper = len(self.remaining)
+        elif lia.unsatisfiable:
+            core = set(self.indicator_to_i[literal] for literal in lia.unsat_assumptions)
+            core_positions = [
+                pos for pos, i in enumerate(self.remaining[:self.upper])
+                if i in core
+            ]
+            if not core_positions: # there is no model even without optional constraints
+                assert not self.kept
+                self.model = None
+                self.finished = True
+            else:
+                self.upper = max(core_positions)
+        else:
+            self.model = None
+            self.finished = True
+
+    # reduces optional_constraints to the kept ones, returns None if no model was found
+    def result(self, optional_constraints):
+        if self.model is None: return None
+        indicators_s = set(self.indicators)
+        kept = sorted(self.always + [self.positions[i] for i in self.kept])
+        optional_constraints[:] = [optional_constraints[i] for i in kept]
+        return Substitution({
+            v : value
+            for v, value in self.model.base_dict.items()
+            if v not in indicators_s
+        })
+
 def get_univ_theorems():
     univ_theorems = [
         Jump.X.length > 0,
@@ -0,0 +1,98 @@
+import hashlib
+import io
+import json
+import sqlite3
+import time
+
+# Persistent cache of solver outcomes, keyed by the hash of the SMT input.
+# Stores the verdict, the unsat core indices, the failed assumptions
+# and the model (by SMT variable names), so a hit restores
+# the outcome of a LiaChecker without running the solver.
+# The least recently used entries are evicted above max_entries.
+
+class SmtCache:
+    def __init__(self, fname, max_entries = 100000):
+        self.fname = fname
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(fname)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS outcomes (
+            key TEXT PRIMARY KEY,
+            verdict TEXT NOT NULL,
+            core TEXT,
+            assumptions TEXT,
+            model TEXT,
+            last_used REAL NOT NULL
+        )""")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def get_key(lia, assumptions = ()):
+        stream = io.StringIO()
+        lia.write_smt(stream, assumptions)
+        return hashlib.sha256(stream.getvalue().encode()).hexdigest()
+
+    # returns True if the outcome got restored into lia
+    def lookup(self, lia, assumptions = (), key = None):
+        if key is None: key = self.get_key(lia, assumptions)
+        row = self.db.execute(
+            "SELECT verdict, core, assumptions, model FROM outcomes WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        self.db.execute("UPDATE outcomes SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+
+        verdict, core, failed, model = row
+        lia.reset_outcome()
+        if verdict == 'sat':
+            lia.set_model(json.loads(model))
+        else:
+            lia.set_unsat_core(json.loads(core))
+            if assumptions:
+                lia.unsat_assumptions = [assumptions[i] for i in json.loads(failed)]
+        return True
+
+    def store(self, lia, assumptions = (), key = None):
+        if key is None: key = self.get_key(lia, assumptions)
+        if lia.satisfiable and lia.sat_model is not None:
+            row = ('sat', None, None, json.dumps(lia.model_values()))
+        elif lia.unsatisfiable:
+            failed = None
+            if assumptions:
+                failed = json.dumps([
+                    i for i, literal in enumerate(assumptions)
+                    if literal in lia.unsat_assumptions
+                ])
+            row = ('unsat', json.dumps(lia.unsat_core_ids), failed, None)
+        else:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?)",
+            (key,) + row + (time.time(),),
+        )
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        [size] = self.db.execute("SELECT COUNT(*) FROM outcomes").fetchone()
+        if size <= self.max_entries: return
+        self.db.execute(
+            "DELETE FROM outcomes WHERE key IN "
+            "(SELECT key FROM outcomes ORDER BY last_used LIMIT ?)",
+            (size - self.max_entries,),
+        )
+        self.evictions += size - self.max_entries
+
+    def show_stats(self):
+        print(f"SMT cache {self.fname}: {self.hits} hits, {self.misses} misses, {self.evictions} evictions")
@@ -1,10 +1,21 @@
 from subprocess import Popen, PIPE
+from weakref import WeakKeyDictionary, ref
 from collections import defaultdict
+import asyncio
+import io
 import itertools
+import os
+import queue
 import re
+import resource
+import signal
 import sys
+import tempfile
+import threading
 
 from logic import *
+from congruence import CongruenceClosure
+from auto_inst import TermIndex
 
 ########      Parsing SMT solver's response
 
@@ -34,7 +45,117 @@ def lisp_parse_tokens(token_iter):
 def lisp_parse_lines(lines):
     return lisp_parse_tokens(lisp_lexer(lines))
 
+# reads lines from a stream until they form a complete s-expression
+def lisp_read_lines(stream):
+    lines = []
+    depth = 0
+    started = False
+    while not started or depth > 0:
+        line = stream.readline()
+        if not line: raise Exception("SMT solver closed the output unexpectedly")
+        i = line.find(';')
+        code = line if i < 0 else line[:i]
+        depth += code.count('(') - code.count(')')
+        if code.strip(): started = True
+        lines.append(line)
+    return lines
+
+# returns None if no line arrives within the timeout (in seconds)
+def readline_timeout(stream, timeout):
+    if timeout is None: return stream.readline()
+    lines = queue.Queue()
+    def read():
+        try: lines.put(stream.readline())
+        except (OSError, ValueError): lines.put('')
+    threading.Thread(target = read, daemon = True).start()
+    try:
+        return lines.get(timeout = timeout)
+    except queue.Empty:
+        return None
+
+def parse_reason_unknown(info_str):
+    m = re.search(r':reason-unknown\s+"?([^")]*)', info_str)
+    if m is None: return "unknown"
+    return m.group(1).strip()
+
+# Limits of a single solver query, timeout in seconds, memory in megabytes.
+# The driver kills a solver that didn't answer within timeout + grace,
+# and limits the address space of the solver process.
+# Solvers which support it also get the limits as their own options,
+# so they can answer "unknown" by themselves. With a memory limit, the error
+# output of the solver is captured to recognize running out of memory,
+# in a temporary file, a pipe nobody reads would block a chatty solver.
+
+class SolverLimits:
+    def __init__(self, timeout = None, memory = None, grace = 1.0):
+        self.timeout = timeout
+        self.memory = memory
+        self.grace = grace
+
+    @property
+    def kill_timeout(self):
+        if self.timeout is None: return None
+        return self.timeout + self.grace
+
+    def solver_cmd(self, cmd):
+        name = os.path.basename(cmd[0])
+        args = []
+        if name == 'z3':
+            if self.timeout is not None: args.append(f"-t:{int(self.timeout*1000)}")
+            if self.memory is not None: args.append(f"-memory:{self.memory}")
+        elif name in ('cvc4', 'cvc5'):
+            if self.timeout is not None: args.append(f"--tlimit-per={int(self.timeout*1000)}")
+        return tuple(cmd) + tuple(args)
+
+    def preexec(self):
+        if self.memory is not None:
+            limit = self.memory * 2**20
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    # the file for the error output of a solver, None to inherit it
+    def error_file(self):
+        if self.memory is None: return None
+        else: return tempfile.TemporaryFile('w+', errors = 'replace')
+
+    @staticmethod
+    def read_error(error_file):
+        if error_file is None: return ''
+        error_file.seek(0)
+        return error_file.read()
+
+    # the Popen keeps its error_file
+    def popen(self, cmd):
+        error_file = self.error_file()
+        popen = Popen(self.solver_cmd(cmd), stdin = PIPE, stdout = PIPE, stderr = error_file,
+                      bufsize=1, universal_newlines=True, preexec_fn = self.preexec)
+        popen.error_file = error_file
+        return popen
+
+    memout_messages = ('out of memory', 'bad_alloc', 'cannot allocate memory', 'memory exhausted')
+
+    # does the exit status or the output show that the solver ran out of memory,
+    # (killed by the OOM killer, or failed allocation reported)
+    def is_memout(self, status, output):
+        if self.memory is None: return False
+        output = output.lower()
+        return status == -signal.SIGKILL or any(msg in output for msg in self.memout_messages)
+
+    # the solver gave the response instead of an answer, did it run out of memory?
+    # If it closed the output, its exit status and error output are checked
+    def memout(self, popen, response):
+        if self.memory is None: return False
+        if response: return self.is_memout(None, response)
+        status = popen.wait()
+        return self.is_memout(status, self.read_error(popen.error_file))
+
+no_limits = SolverLimits()
+
+# frames: (weak reference, sizes) of the LiaCheckers this one was cloned from,
+#   with their sizes at the time (see sizes), this one starts with the same
+#   prefix, an SmtSession keeps such a prefix in its own frame for all the clones
+
 class LiaChecker:
+    max_frames = 16
     bool_const_to_smt = {
         TermBool.true : 'true',
         TermBool.false : 'false',
@@ -57,13 +178,30 @@ class LiaChecker:
         self.bool_vars_d = dict()
         self.constraints = []
         self.constraints_s = set()
+        self.term_index = TermIndex() # atoms for matching in auto_inst
+        self.smt_defs = dict() # shared subterms -> names, only while writing
+        self.skeletons = WeakKeyDictionary() # atom -> get_skeleton(atom), shared by the clones
+        self.frames = []
+        self.reset_outcome()
+
+    def reset_outcome(self):
         self.satisfiable = False
         self.unsatisfiable = False
         self.unsat_core = None
         self.unsat_core_ids = None
+        self.unsat_assumptions = None
         self.sat_model = None
+        self.unknown = False
+        self.unknown_reason = None
+
+    # the solver gave up, reason is e.g. "timeout", "memout", "incomplete"
+    def set_unknown(self, reason):
+        self.unknown = True
+        self.unknown_reason = reason
 
-    def clone(self): # only constraints & terms, not cloning solver's outcome
+    # only constraints & terms, not cloning solver's outcome,
+    # the term_index of the clone is a layer over this one
+    def clone(self):
         res = LiaChecker()
         res.int_vars = list(self.int_vars)
         res.int_vars_d = dict(self.int_vars_d)
@@ -71,18 +209,38 @@ class LiaChecker:
         res.bool_vars_d = dict(self.bool_vars_d)
         res.constraints = list(self.constraints)
         res.constraints_s = set(self.constraints_s)
+        res.term_index = self.term_index.layer()
+        res.skeletons = self.skeletons
+        sizes = self.sizes()
+        if len(self.frames) >= self.max_frames: res.frames = [(ref(self), sizes)]
+        elif self.frames and self.frames[-1][1] == sizes: res.frames = list(self.frames)
+        else: res.frames = self.frames + [(ref(self), sizes)]
         return res
 
-    def add_term(self, term):
+    # numbers of bool vars, int vars and constraints
+    def sizes(self):
+        return len(self.bool_vars), len(self.int_vars), len(self.constraints)
+
+    # subterms represented by SMT variables, each once
+    def atoms_iter(self, term):
         for subterm in term.subterms_iter():
             if isinstance(subterm, TermInt) and subterm.f != TermInt._mk:
-                if subterm not in self.int_vars_d:
-                    self.int_vars_d[subterm] = 'i'+str(len(self.int_vars))
-                    self.int_vars.append(subterm)
+                yield subterm
             elif isinstance(subterm, TermBool) and not (self._has_bool_op(subterm) or self._has_int_op(subterm)):
-                if subterm not in self.bool_vars_d:
-                    self.bool_vars_d[subterm] = 'b'+str(len(self.bool_vars))
-                    self.bool_vars.append(subterm)
+                yield subterm
+
+    def add_term(self, term):
+        for atom in self.atoms_iter(term):
+            if isinstance(atom, TermInt):
+                if atom not in self.int_vars_d:
+                    self.int_vars_d[atom] = 'i'+str(len(self.int_vars))
+                    self.int_vars.append(atom)
+                    self.term_index.add(atom)
+            else:
+                if atom not in self.bool_vars_d:
+                    self.bool_vars_d[atom] = 'b'+str(len(self.bool_vars))
+                    self.bool_vars.append(atom)
+                    self.term_index.add(atom)
 
     def add_constraint(self, constraint):
         if constraint == TermBool.true: return
@@ -124,19 +282,19 @@ class LiaChecker:
             arg_list,
         )
 
+    # congruence rules are needed only for atoms not already known equal
+    # by the congruence closure of the constraints, see congruence.py
     def get_congruence_theorems(self):
         skeleton_to_instances = defaultdict(list)
         for term in itertools.chain(self.bool_vars, self.int_vars):
-            skeleton, arg_list = self.get_skeleton(term)
-            instances = skeleton_to_instances[skeleton]
-            for term2, arg_list2 in instances:
-                assert len(arg_list2) == len(arg_list)
-                assert type(term) == type(term2)
-                yield ~conjunction(*(
-                    equals(arg1,arg2)
-                    for arg1,arg2 in zip(arg_list, arg_list2)
-                )) | equals(term, term2)
-            instances.append((term, arg_list))
+            res = self.skeletons.get(term)
+            if res is None:
+                res = self.get_skeleton(term)
+                self.skeletons[term] = res
+            skeleton, arg_list = res
+            skeleton_to_instances[skeleton].append((term, arg_list))
+        closure = CongruenceClosure(skeleton_to_instances.values(), self.constraints)
+        return closure.get_theorems()
 
     def add_congruence_theorems(self):
         self.constraints.extend(self.get_congruence_theorems())
@@ -149,6 +307,7 @@ class LiaChecker:
 
     def _prop_to_smt(self, prop):
         if prop in self.bool_vars_d: return self.bool_vars_d[prop]
+        elif prop in self.smt_defs: return self.smt_defs[prop]
         elif prop in self.bool_const_to_smt: return self.bool_const_to_smt[prop]
         elif self._has_bool_op(prop):
             args = [self._prop_to_smt(arg) for arg in prop.args]
@@ -158,7 +317,9 @@ class LiaChecker:
             return self._smt_str(self.int_op_to_smt[prop.f], *args)
 
     def _term_int_to_smt(self, term):
-        if term.f == TermInt._mk:
+        if term in self.smt_defs:
+            return self.smt_defs[term]
+        elif term.f == TermInt._mk:
             if not term.args:
                 if term.const >= 0: return str(term.const)
                 else:
@@ -177,91 +338,287 @@ class LiaChecker:
         else:
             raise Exception(f"Cannot convert to SMT: {term}")
 
-    def write_smt(self, stream):
-        header = """(set-option :produce-unsat-cores true)
+    smt_header = """(set-option :produce-unsat-cores true)
+(set-option :produce-unsat-assumptions true)
 (set-option :produce-models true)
 (set-logic LIA)
 """
-        stream.write(header)
+
+    def write_smt_declarations(self, stream, bool_start = 0, int_start = 0, bool_end = None, int_end = None):
+        for v in self.bool_vars[bool_start:bool_end]:
+            stream.write(f"(declare-const {self.bool_vars_d[v]} Bool)\n")
+        for v in self.int_vars[int_start:int_end]:
+            stream.write(f"(declare-const {self.int_vars_d[v]} Int)\n")
+
+    ########  Sharing of subterms in the SMT output
+
+    # subterms printed as arguments by _prop_to_smt and _term_int_to_smt
+    def _smt_children(self, term):
+        if term in self.bool_vars_d or term in self.int_vars_d or term in self.bool_const_to_smt:
+            return ()
+        elif isinstance(term, TermInt):
+            if term.f != TermInt._mk or not term.args: return ()
+            elif len(term.args) == 1 and not term.const: return (term.args[0],)
+            summands = [mul * arg for mul, arg in zip(term.muls, term.args)]
+            if term.const != 0: summands.append(TermInt(term.const))
+            return summands
+        else:
+            return term.args
+
+    # compound subterms used more than once by the given constraints,
+    # having a compound argument, in the order children before parents
+    def _shared_subterms(self, constraints):
+        counts = dict()
+        order = []
+        for constraint in constraints:
+            stack = [(constraint, False)]
+            while stack:
+                term, expanded = stack.pop()
+                if expanded:
+                    order.append(term)
+                    continue
+                if term in counts:
+                    counts[term] += 1
+                    continue
+                counts[term] = 1
+                children = self._smt_children(term)
+                if not children: continue
+                stack.append((term, True))
+                stack.extend((child, False) for child in children)
+        return [
+            term for term in order
+            if counts[term] >= 2 and any(self._smt_children(arg) for arg in self._smt_children(term))
+        ]
+
+    # shared subterms are written once as define-fun, named by the first
+    # written constraint, so that names from different starts don't clash
+    def write_smt_constraints(self, stream, start = 0, end = None):
+        constraints = self.constraints[start:end]
+        self.smt_defs = dict()
+        for i, term in enumerate(self._shared_subterms(constraints)):
+            if isinstance(term, TermInt):
+                sort, value = 'Int', self._term_int_to_smt(term)
+            else:
+                sort, value = 'Bool', self._prop_to_smt(term)
+            name = f"d{start}_{i}"
+            stream.write(f"(define-fun {name} () {sort} {value})\n")
+            self.smt_defs[term] = name
+        for i,constraint in enumerate(constraints, start):
+            stream.write(f"(assert (! {self._prop_to_smt(constraint)} :named constraint-{i}))\n")
+        self.smt_defs = dict()
+
+    # assumptions: literals holding only for this check (check-sat-assuming)
+    def write_check_sat(self, stream, assumptions = ()):
+        if assumptions:
+            literals = ' '.join(self._prop_to_smt(literal) for literal in assumptions)
+            stream.write(f"(check-sat-assuming ({literals}))\n")
+        else:
+            stream.write("(check-sat)\n")
+
+    def write_smt(self, stream, assumptions = ()):
+        stream.write(self.smt_header)
         stream.write("\n; declarations\n")
-        for v in self.bool_vars_d.values():
-            stream.write(f"(declare-const {v} Bool)\n")
-        for v in self.int_vars_d.values():
-            stream.write(f"(declare-const {v} Int)\n")
+        self.write_smt_declarations(stream)
         stream.write("\n; constraints\n")
-        for i,constraint in enumerate(self.constraints):
-            stream.write(f"(assert (! {self._prop_to_smt(constraint)} :named constraint-{i}))\n")
-        stream.write("(check-sat)\n")
+        self.write_smt_constraints(stream)
+        self.write_check_sat(stream, assumptions)
 
     ########  Running a solver
 
+    def read_model(self, model_lines):
+        model_lisp = lisp_parse_lines(model_lines)
+        if model_lisp and model_lisp[0] == 'model':
+            model_lisp.pop(0)
+        values = {}
+        for (define_fun, var_name, empty, t, value) in model_lisp:
+            assert define_fun == 'define-fun'
+            if var_name.startswith('constraint-'): continue
+            if re.fullmatch(r'd\d+_\d+', var_name): continue # shared subterm
+            assert empty == []
+            if t == 'Int':
+                if isinstance(value, str):
+                    assert value.isnumeric()
+                    value = int(value)
+                else:
+                    assert len(value) == 2 and value[0] == '-' and value[1].isnumeric()
+                    value = -int(value[1])
+            elif t == 'Bool':
+                assert isinstance(value, str)
+                if value == 'true': value = True
+                elif value == 'false': value = False
+                else: raise Exception(f"Unexpected bool value {value}")
+            else:
+                raise Exception(f"Unexpected SMT type {t}: {var_name}")
+            values[var_name] = value
+        self.set_model(values)
+
+    # values: SMT variable name -> int / bool
+    def set_model(self, values):
+        self.satisfiable = True
+        var_name_to_var = dict()
+        for v,name in self.bool_vars_d.items(): var_name_to_var[name] = v
+        for v,name in self.int_vars_d.items(): var_name_to_var[name] = v
+
+        model = {}
+        for var_name, value in values.items():
+            v = var_name_to_var[var_name]
+            if isinstance(v, TermInt):
+                assert isinstance(value, int) and not isinstance(value, bool)
+                value = TermInt(value)
+            elif isinstance(v, TermBool):
+                assert isinstance(value, bool)
+                value = TermBool(value)
+            else:
+                raise Exception(f"Unexpected term type {type(v)}: {v}")
+            model[v] = value
+        self.sat_model = Substitution(model)
+
+    def model_values(self):
+        values = {}
+        for v, value in self.sat_model.base_dict.items():
+            if isinstance(v, TermBool): values[self.bool_vars_d[v]] = value.value()
+            else: values[self.int_vars_d[v]] = value.value()
+        return values
+
+    def read_unsat_core(self, unsat_core_lines):
+        unsat_core_lisp = lisp_parse_lines(unsat_core_lines)
+        used_indices = []
+        for label in unsat_core_lisp:
+            if self._is_assumption_label(label): continue
+            assert isinstance(label, str) and '-' in label
+            label,i = label.split('-')
+            assert label == "constraint"
+            i = int(i)
+            used_indices.append(i)
+        self.set_unsat_core(used_indices)
+
+    def set_unsat_core(self, used_indices):
+        self.unsatisfiable = True
+        assert all(0 <= i < len(self.constraints) for i in used_indices)
+        assert len(set(used_indices)) == len(used_indices)
+        used_constraints = [self.constraints[i] for i in used_indices]
+        self.unsat_core_ids = used_indices
+        self.unsat_core = used_constraints
+
+    def read_unsat_assumptions(self, lines, assumptions):
+        literal_d = {
+            self._prop_to_smt(literal) : literal
+            for literal in assumptions
+        }
+        labels = [
+            self._smt_str(*label) if isinstance(label, list) else label
+            for label in lisp_parse_lines(lines)
+        ]
+        # some solvers report also named assertions
+        self.unsat_assumptions = [
+            literal_d[label]
+            for label in labels
+            if label in literal_d
+        ]
+
+    # literals of check-sat-assuming can appear in the unsat core
+    def _is_assumption_label(self, label):
+        if isinstance(label, list):
+            return len(label) == 2 and label[0] == 'not' and self._is_assumption_label(label[1])
+        return label in self.bool_vars_d.values()
+
     # cmd = ('z3', '-in', '-smt2')
     # cmd = ('cvc4', '-m', '--lang', 'smt')
-    def solve(self, cmd):
-        popen = Popen(cmd, stdin = PIPE, stdout = PIPE, bufsize=1,
-                      universal_newlines=True)
+    # cache: optional SmtCache skipping the solver on repeated problems
+    # limits: SolverLimits, timeouts and memouts end as set_unknown
+    def solve(self, cmd, cache = None, limits = no_limits):
+        self.reset_outcome()
+        if cache is not None:
+            key = cache.get_key(self)
+            if cache.lookup(self, key = key): return
+        popen = limits.popen(cmd)
         self.write_smt(popen.stdin)
         # self.write_smt(sys.stdout)
 
-        response = popen.stdout.readline()
-        if response.strip() == "sat":
-            self.satisfiable = True
+        response = readline_timeout(popen.stdout, limits.kill_timeout)
+        if response is None:
+            popen.kill()
+            popen.wait()
+            self.set_unknown("timeout")
+        elif response.strip() == "unknown":
+            info_str, _ = popen.communicate("(get-info :reason-unknown)\n")
+            self.set_unknown(parse_reason_unknown(info_str))
+        elif limits.memout(popen, response):
+            popen.kill()
+            popen.wait()
+            self.set_unknown("memout")
+        elif response.strip() == "sat":
             model_str,_ = popen.communicate("(get-model)\n")
-            model_lisp = lisp_parse_lines(model_str.split('\n'))
-            if model_lisp and model_lisp[0] == 'model':
-                model_lisp.pop(0)
-            model = {}
-
-            var_name_to_var = dict()
-            for v,name in self.bool_vars_d.items(): var_name_to_var[name] = v
-            for v,name in self.int_vars_d.items(): var_name_to_var[name] = v
-
-            for (define_fun, var_name, empty, t, value) in model_lisp:
-                assert define_fun == 'define-fun'
-                if var_name.startswith('constraint-'): continue
-                v = var_name_to_var[var_name]
-                assert empty == []
-                if isinstance(v, TermInt):
-                    assert t == 'Int'
-                    if isinstance(value, str):
-                        assert value.isnumeric()
-                        value = int(value)
-                    else:
-                        assert len(value) == 2 and value[0] == '-' and value[1].isnumeric()
-                        value = -int(value[1])
-                    value = TermInt(value)
-                elif isinstance(v, TermBool):
-                    assert t == 'Bool'
-                    assert isinstance(value, str)
-                    if value == 'true': value = True
-                    elif value == 'false': value = False
-                    else: raise Exception(f"Unexpected bool value {value}")
-                    value = TermBool(value)
-                else:
-                    raise Exception(f"Unexpected term type {type(v)}: {v}")
-                model[v] = value
-            self.sat_model = Substitution(model)
+            self.read_model(model_str.split('\n'))
         elif response.strip() == "unsat":
-            self.unsatisfiable = True
             unsat_core_str, _ = popen.communicate("(get-unsat-core)\n")
-            unsat_core_lisp = lisp_parse_lines(unsat_core_str.split('\n'))
-            used_indices = []
-            for label in unsat_core_lisp:
-                assert isinstance(label, str) and '-' in label
-                label,i = label.split('-')
-                assert label == "constraint"
-                i = int(i)
-                assert 0 <= i < len(self.constraints)
-                used_indices.append(i)
-            assert len(set(used_indices)) == len(used_indices)
-            used_constraints = [self.constraints[i] for i in used_indices]
-            self.unsat_core_ids = used_indices
-            self.unsat_core = used_constraints
+            self.read_unsat_core(unsat_core_str.split('\n'))
         else:
             finish, _ = popen.communicate('')
             print(response, end = '')
             print(finish)
             raise Exception("Didn't get an answer from an SMT solver")
+        if cache is not None:
+            cache.store(self, key = key)
+
+    # the same as solve, running the solver with asyncio.subprocess
+    async def solve_async(self, cmd, assumptions = (), cache = None, limits = no_limits):
+        self.reset_outcome()
+        if cache is not None:
+            key = cache.get_key(self, assumptions)
+            if cache.lookup(self, assumptions, key = key): return
+        error_file = limits.error_file()
+        proc = await asyncio.create_subprocess_exec(
+            *limits.solver_cmd(cmd),
+            stdin = PIPE, stdout = PIPE, stderr = error_file,
+            preexec_fn = limits.preexec,
+        )
+        stream = io.StringIO()
+        self.write_smt(stream, assumptions)
+        proc.stdin.write(stream.getvalue().encode())
+        await proc.stdin.drain()
+
+        async def query(commands):
+            out, _ = await proc.communicate(commands.encode())
+            return io.StringIO(out.decode())
+
+        try:
+            response = await asyncio.wait_for(proc.stdout.readline(), limits.kill_timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            self.set_unknown("timeout")
+            return
+        response = response.decode()
+        if response.strip() == "unknown":
+            info = await query("(get-info :reason-unknown)\n")
+            self.set_unknown(parse_reason_unknown(info.getvalue()))
+        elif limits.memory is not None and not response and limits.is_memout(
+            await proc.wait(), limits.read_error(error_file),
+        ):
+            self.set_unknown("memout")
+        elif limits.is_memout(None, response):
+            proc.kill()
+            await proc.wait()
+            self.set_unknown("memout")
+        elif response.strip() == "sat":
+            out = await query("(get-model)\n")
+            self.read_model(lisp_read_lines(out))
+        elif response.strip() == "unsat":
+            if assumptions:
+                out = await query("(get-unsat-core)\n(get-unsat-assumptions)\n")
+                self.read_unsat_core(lisp_read_lines(out))
+                self.read_unsat_assumptions(lisp_read_lines(out), assumptions)
+            else:
+                out = await query("(get-unsat-core)\n")
+                self.read_unsat_core(lisp_read_lines(out))
+        else:
+            finish = await query('')
+            print(response, end = '')
+            print(finish.getvalue())
+            raise Exception("Didn't get an answer from an SMT solver")
+        if cache is not None:
+            cache.store(self, assumptions, key = key)
 
     #######  Printing
 
@@ -290,3 +647,293 @@ class LiaChecker:
             for constraint in self.unsat_core:
                 print(f"  {constraint}")
             print()
+
+# Remembers unsat cores of solved problems, so that any later problem
+# containing a known core is contradictory without running a solver.
+# Terms are shared, so a core is a set of constraints compared by identity.
+# Every core is indexed by one of its constraints, a query then only checks
+# the cores indexed by the constraints it contains.
+
+class UnsatCoreIndex:
+    def __init__(self):
+        self.cores = set()
+        self.index = defaultdict(list)
+
+    def add(self, core):
+        core = frozenset(core)
+        if not core or core in self.cores: return
+        self.cores.add(core)
+        self.index[next(iter(core))].append(core)
+
+    def find(self, constraints):
+        constraints_s = set(constraints)
+        for constraint in constraints_s:
+            for core in self.index.get(constraint, ()):
+                if core <= constraints_s: return core
+        return None
+
+    def __len__(self):
+        return len(self.cores)
+
+# Runs several solvers on the same problem at once, takes the first
+# sat / unsat answer and kills the rest. The solvers are started in the order
+# of their number of wins so far, max_parallel limits how many of them run.
+# A portfolio solves one-shot queries only (prover.solve_lia and
+# prove_contradiction without a session, given as solver_cmd explicitly,
+# the default_solver is bound as a default value). It cannot run
+# an incremental SmtSession, so GrasshopperEnv and get_model reject it.
+
+class SolverPortfolio:
+    def __init__(self, cmds, max_parallel = None, limits = no_limits):
+        self.cmds = list(cmds)
+        self.max_parallel = max_parallel
+        self.limits = limits
+        self.wins = { cmd : 0 for cmd in self.cmds }
+        self.unavailable = set()
+
+    @staticmethod
+    def _run(i, popen, smt_input, responses):
+        try:
+            popen.stdin.write(smt_input)
+            popen.stdin.flush()
+            response = popen.stdout.readline()
+        except (OSError, ValueError): # killed, or failed to start
+            response = ''
+        responses.put((i, response))
+
+    def solve(self, lia, cache = None):
+        lia.reset_outcome()
+        if cache is not None:
+            key = cache.get_key(lia)
+            if cache.lookup(lia, key = key): return
+        stream = io.StringIO()
+        lia.write_smt(stream)
+        smt_input = stream.getvalue()
+
+        cmds = [cmd for cmd in self.cmds if cmd not in self.unavailable]
+        cmds = cmds[:self.max_parallel]
+        popens = dict()
+        responses = queue.Queue()
+        for i, cmd in enumerate(cmds):
+            try:
+                popen = self.limits.popen(cmd)
+            except FileNotFoundError:
+                self.unavailable.add(cmd)
+                continue
+            popens[i] = popen
+            threading.Thread(
+                target = self._run,
+                args = (i, popen, smt_input, responses),
+                daemon = True,
+            ).start()
+        if not popens:
+            raise Exception(f"None of the solvers is available: {self.cmds}")
+
+        winner = None
+        failed_responses = []
+        memout = False # some failed solver ran out of memory
+        timed_out = False
+        for _ in range(len(popens)):
+            try:
+                i, response = responses.get(timeout = self.limits.kill_timeout)
+            except queue.Empty:
+                timed_out = True
+                break
+            if response.strip() in ("sat", "unsat"):
+                winner = i
+                break
+            failed_responses.append(response)
+            if self.limits.memout(popens[i], response): memout = True
+        for i, popen in popens.items():
+            if i == winner: continue
+            popen.kill()
+            popen.wait()
+
+        if winner is None:
+            if timed_out:
+                lia.set_unknown("timeout")
+                return
+            elif any(response.strip() == "unknown" for response in failed_responses):
+                lia.set_unknown("unknown")
+                return
+            elif memout:
+                lia.set_unknown("memout")
+                return
+            for response in failed_responses: print(response, end = '')
+            raise Exception("Didn't get an answer from any SMT solver")
+        popen = popens[winner]
+        if response.strip() == "sat":
+            model_str,_ = popen.communicate("(get-model)\n")
+            lia.read_model(model_str.split('\n'))
+        else:
+            unsat_core_str, _ = popen.communicate("(get-unsat-core)\n")
+            lia.read_unsat_core(unsat_core_str.split('\n'))
+        self.wins[cmds[winner]] += 1
+        self.cmds.sort(key = lambda cmd: -self.wins[cmd])
+        if cache is not None:
+            cache.store(lia, key = key)
+
+    def show_stats(self):
+        print("Solver wins:")
+        for cmd in self.cmds:
+            if cmd in self.unavailable: wins = "unavailable"
+            else: wins = self.wins[cmd]
+            print(f"  {' '.join(cmd)}: {wins}")
+
+# Keeps a single solver process running in the incremental mode.
+# Every solved LiaChecker stays asserted in a (push) frame, so a following
+# LiaChecker which extends it (has its variables and constraints as a prefix)
+# only sends the new declarations and assertions to the solver.
+# The command has to support incremental solving, e.g.
+# cmd = ('z3', '-in', '-smt2')
+# cmd = ('cvc4', '-m', '-i', '--lang', 'smt')
+
+class SmtSession:
+    def __init__(self, cmd, cache = None, limits = no_limits):
+        self.popen = None
+        if isinstance(cmd, SolverPortfolio):
+            raise TypeError("SolverPortfolio supports only one-shot solving, not an SmtSession")
+        self.cmd = cmd
+        self.cache = cache # optional SmtCache
+        self.limits = limits # SolverLimits of every query
+        self.frames = [] # (weak reference to a LiaChecker, its sizes) after each push
+        self.bool_vars = []
+        self.int_vars = []
+        self.constraints = []
+
+    def start(self):
+        self.popen = self.limits.popen(self.cmd)
+        self.popen.stdin.write(LiaChecker.smt_header)
+        self.frames = []
+        self.bool_vars = []
+        self.int_vars = []
+        self.constraints = []
+
+    def close(self):
+        if self.popen is None: return
+        try:
+            self.popen.communicate("(exit)\n", timeout = 1)
+        except Exception:
+            self.popen.kill()
+            self.popen.wait()
+        self.popen = None
+
+    # a session dropped without close (e.g. after a failed proof)
+    # must not leave the solver running
+    def __del__(self):
+        if self.popen is None: return
+        self.popen.kill()
+        self.popen.wait()
+
+    def _sizes(self, depth):
+        if depth == 0: return 0,0,0
+        else: return self.frames[depth-1][1]
+
+    # the frames of lia (see LiaChecker) ending with lia itself
+    @staticmethod
+    def _lia_frames(lia):
+        res = list(lia.frames)
+        sizes = lia.sizes()
+        if not res or res[-1][1] != sizes: res.append((ref(lia), sizes))
+        return res
+
+    # number of frames consistent with the given LiaChecker, a frame pushed
+    # for the same prefix of a LiaChecker is recognized without comparing
+    def _matching_depth(self, lia, lia_frames):
+        keys = set()
+        for key, sizes in lia_frames:
+            key = key()
+            if key is not None: keys.add((id(key), sizes))
+        last = (0,0,0)
+        for depth, (key, sizes) in enumerate(self.frames):
+            key = key()
+            if key is None or (id(key), sizes) not in keys:
+                nb, ni, nc = sizes
+                lb, li, lc = last
+                if len(lia.bool_vars) < nb or len(lia.int_vars) < ni or len(lia.constraints) < nc:
+                    return depth
+                if (
+                    lia.bool_vars[lb:nb] != self.bool_vars[lb:nb] or
+                    lia.int_vars[li:ni] != self.int_vars[li:ni] or
+                    lia.constraints[lc:nc] != self.constraints[lc:nc]
+                ):
+                    return depth
+            last = sizes
+        return len(self.frames)
+
+    # every frame of lia beyond the matching ones gets pushed on its own,
+    # so the frame of a shared prefix stays when only the rest changes
+    def _assert_lia(self, lia):
+        stream = self.popen.stdin
+        lia_frames = self._lia_frames(lia)
+        depth = self._matching_depth(lia, lia_frames)
+        if depth < len(self.frames):
+            stream.write(f"(pop {len(self.frames) - depth})\n")
+            nb, ni, nc = self._sizes(depth)
+            del self.frames[depth:]
+            del self.bool_vars[nb:]
+            del self.int_vars[ni:]
+            del self.constraints[nc:]
+        nb, ni, nc = self._sizes(depth)
+        for key, sizes in lia_frames:
+            eb, ei, ec = (max(a, b) for a, b in zip((nb, ni, nc), sizes))
+            if (eb, ei, ec) == (nb, ni, nc): continue
+            if (eb, ei, ec) != sizes: key = ref(lia) # not aligned with the frame of key
+            stream.write("(push 1)\n")
+            lia.write_smt_declarations(stream, nb, ni, eb, ei)
+            lia.write_smt_constraints(stream, nc, ec)
+            self.frames.append((key, (eb, ei, ec)))
+            self.bool_vars.extend(lia.bool_vars[nb:eb])
+            self.int_vars.extend(lia.int_vars[ni:ei])
+            self.constraints.extend(lia.constraints[nc:ec])
+            nb, ni, nc = eb, ei, ec
+
+    def _query(self, command):
+        self.popen.stdin.write(command+'\n')
+        self.popen.stdin.flush()
+        return lisp_read_lines(self.popen.stdout)
+
+    # assumptions are boolean literals over lia's variables,
+    # they hold only for this check (check-sat-assuming)
+    def solve(self, lia, assumptions = ()):
+        lia.reset_outcome()
+        if self.cache is not None:
+            key = self.cache.get_key(lia, assumptions)
+            if self.cache.lookup(lia, assumptions, key = key): return
+        if self.popen is None: self.start()
+        self._assert_lia(lia)
+        lia.write_check_sat(self.popen.stdin, assumptions)
+        self.popen.stdin.flush()
+
+        response = readline_timeout(self.popen.stdout, self.limits.kill_timeout)
+        if response is None: # the solver state is lost with the process
+            self.popen.kill()
+            self.popen.wait()
+            self.popen = None
+            lia.set_unknown("timeout")
+            return
+        elif response.strip() == "unknown":
+            info_lines = self._query("(get-info :reason-unknown)")
+            lia.set_unknown(parse_reason_unknown(''.join(info_lines)))
+            return
+        elif self.limits.memout(self.popen, response):
+            self.popen.kill()
+            self.popen.wait()
+            self.popen = None
+            lia.set_unknown("memout")
+            return
+        elif response.strip() == "sat":
+            lia.read_model(self._query("(get-model)"))
+        elif response.strip() == "unsat":
+            lia.read_unsat_core(self._query("(get-unsat-core)"))
+            if assumptions:
+                lia.read_unsat_assumptions(self._query("(get-unsat-assumptions)"), assumptions)
+        else:
+            self.popen.kill()
+            finish, _ = self.popen.communicate()
+            self.popen = None
+            print(response, end = '')
+            print(finish)
+            raise Exception("Didn't get an answer from an SMT solver")
+        if self.cache is not None:
+            self.cache.store(lia, assumptions, key = key)
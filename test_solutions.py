@@ -1,6 +1,14 @@
 #!/usr/bin/python
 
-from env import GrasshopperEnv
+import argparse
+import gc
+import sys
+import weakref
+from env import GrasshopperEnv, LogicContext
+from logic import TermInt, MineField, conjunction, disjunction, equals, term_table
+from prover import CompiledFacts, FailedProof, default_session_solver, prove_contradiction
+from smt_cache import SmtCache
+from smt_lia import SmtSession, SolverLimits
 from solution_basic import solution as solution_basic
 from solution_a3m2 import solution as solution_a3m2
 from solution_a5 import solution as solution_a5
@@ -9,14 +17,174 @@ from solution2_basic import solution as solution2_basic
 def test_solution(name, solution, **kwargs):
     print(f"Solution {name}:")
     print()
-    env = GrasshopperEnv(**kwargs)
-    solution(env)    
-    env.check_solved()
+    with GrasshopperEnv(**kwargs) as env:
+        solution(env)    
+        env.check_solved()
+    print()
+
+# a case contradictory already by its assumption gets closed without steps,
+# the other one stays pending
+def test_close_pending(name, **kwargs):
+    print(f"Closing pending cases {name}:")
+    with GrasshopperEnv(**kwargs) as env:
+        env.split_case(env.size >= 0)
+        env.split_case(env.mines.count > 0)
+        env.close_pending()
+        assert len(env.ctx_stack) == 1
+    print()
+
+# The quantified fact clausifies with definition atoms (32 clauses otherwise),
+# the contradiction is found only if add_ground_clause unfolds
+# the definitions in its instance.
+def test_definitions():
+    print("Definitions of the clausification:")
+    X = TermInt.X
+    mines = MineField.fixed_var('mines')
+    k = TermInt.fixed_var('k')
+    cs = [TermInt.fixed_var(f"c{i}") for i in range(5)]
+    fact = ~mines[X] | disjunction(*(
+        conjunction(equals(X, i), c > i)
+        for i, c in enumerate(cs)
+    ))
+    assert any(atom.is_definition for atom in fact.clausify().atoms())
+    constraints = [fact] + [c <= i for i, c in enumerate(cs)] + [mines[k]]
+    prove_contradiction(constraints)
+    prove_contradiction(constraints, base = CompiledFacts(constraints[:1]))
+    try:
+        prove_contradiction(constraints[:-2] + [mines[k]])
+    except FailedProof:
+        pass
+    else:
+        raise Exception("Proven without the needed fact")
+    print("OK")
+    print()
+
+def test_definitions_released():
+    print("Definition atoms released with their problem:")
+    X = TermInt.X
+    mines = MineField.fixed_var('mines')
+    cs = [TermInt.fixed_var(f"c{i}") for i in range(5)]
+    fact = ~mines[X] | disjunction(*(
+        conjunction(equals(X, i), c > i)
+        for i, c in enumerate(cs)
+    ))
+    term_table.set_retention(term_table.generation_size, 0)
+    try:
+        definition = next(atom.f for atom in fact.clausify().atoms() if atom.is_definition)
+        definition = weakref.ref(definition)
+        gc.collect()
+        assert definition() is None
+    finally:
+        term_table.set_retention(term_table.generation_size, 4)
+    print("OK")
+    print()
+
+def test_model_constraints():
+    print("Unsatisfiable model constraints:")
+    x = TermInt.fixed_var('x')
+    ctx = LogicContext([], {x : None}, [], None)
+    ctx.add_fact(x >= 0)
+    ctx.add_model_constraints(equals(x, TermInt(-3)))
+    model = ctx.get_model()
+    assert model is not None and model[x].const >= 0
+    assert not any(constraint == equals(x, TermInt(-3)) for constraint in ctx.model_constraints)
+    print("OK")
+    print()
+
+def test_trivial_model_constraint():
+    print("Model constraint implied by the facts:")
+    x = TermInt.fixed_var('x')
+    y = TermInt.fixed_var('y')
+    ctx = LogicContext([], {x : None, y : None}, [], None)
+    ctx.add_model_constraints(equals(x, TermInt(0)))
+    ctx.add_fact(equals(x, TermInt(0)))
+    ctx.add_fact(y >= 3)
+    model = ctx.get_model()
+    assert model is not None and model[y].const >= 3
+    assert list(ctx.model_constraints) == [equals(x, TermInt(0))]
+    print("OK")
+    print()
+
+def test_model_new_var():
+    print("Cached model after a new variable:")
+    x = TermInt.fixed_var('x')
+    ctx = LogicContext([], {x : None}, [], None)
+    ctx.add_fact(x >= 0)
+    assert ctx.get_model() is not None
+    mines = MineField.fixed_var('mines')
+    ctx.add_var(mines)
+    model = ctx.get_model()
+    assert model[mines.length].value() >= 0
+    assert model[mines.count].value() >= 0
+    print("OK")
+    print()
+
+def test_session_frames():
+    print("Goals over a shared base in a session:")
+    xs = [TermInt.fixed_var(f"x{i}") for i in range(10)]
+    base = CompiledFacts([xs[i] <= xs[i+1] for i in range(len(xs)-1)])
+    session = SmtSession(default_session_solver)
+    try:
+        for i in range(1, len(xs)):
+            lia = base.to_lia([~(xs[0] <= xs[i])])
+            session.solve(lia)
+            assert lia.unsatisfiable
+            if i == 1: base_frame = session.frames[0]
+            assert session.frames[0] is base_frame # only the goal gets popped
+    finally:
+        session.close()
+    print("OK")
+    print()
+
+# answers sat to every query, with a lot of error output
+chatty_solver = """
+import sys
+for line in sys.stdin:
+    if line.startswith('(check-sat'):
+        sys.stderr.write('warning: chatty solver\\n' * 10000)
+        sys.stderr.flush()
+        print('sat', flush = True)
+    elif line.startswith('(get-model'):
+        print('(model\\n)', flush = True)
+    elif line.startswith('(exit'):
+        break
+"""
+
+def test_chatty_session():
+    print("Session with a memory limit and a chatty solver:")
+    x = TermInt.fixed_var('x')
+    limits = SolverLimits(timeout = 10, memory = 1000)
+    session = SmtSession((sys.executable, '-c', chatty_solver), limits = limits)
+    try:
+        for i in range(5):
+            lia = CompiledFacts([x >= i]).to_lia()
+            session.solve(lia)
+            assert lia.satisfiable, lia.unknown_reason
+    finally:
+        session.close()
+    print("OK")
     print()
 
 if __name__ == "__main__":
-    test_solution("basic", solution_basic)
-    test_solution("A3 M2", solution_a3m2, auto_assume = True)
-    test_solution("A5", solution_a5, auto_assume = True)
-    test_solution("variant2", solution2_basic)
+    cmd_parser = argparse.ArgumentParser(prog='test_solutions.py',
+                                         description='Checks the example solutions and a few prover features',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    cmd_parser.add_argument('--cache',  default=None, type=str,
+                            help = "SMT cache file to answer the solver queries from (default: no cache, every query goes to the solver)")
+    config = cmd_parser.parse_args()
 
+    cache = None if config.cache is None else SmtCache(config.cache)
+    test_solution("basic", solution_basic, cache = cache)
+    test_solution("A3 M2", solution_a3m2, auto_assume = True, cache = cache)
+    test_solution("A5", solution_a5, auto_assume = True, cache = cache)
+    test_solution("variant2", solution2_basic, cache = cache)
+    test_close_pending("sequentially", cache = cache)
+    test_definitions()
+    test_definitions_released()
+    test_model_constraints()
+    test_trivial_model_constraint()
+    test_model_new_var()
+    test_session_frames()
+    test_chatty_session()
+    test_close_pending("in a pool", workers = 2)
+    if cache is not None: cache.show_stats()
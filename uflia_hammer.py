@@ -1,4 +1,4 @@
-from logic import TermInt, TermBool, Jump, Jumps, MineField, JumpSet, term_fun, equals, conjunction, disjunction
+from logic import TermInt, TermBool, Jump, Jumps, MineField, JumpSet, term_fun, equals, conjunction, disjunction, normal_form
 
 class UFLIA:
     def __init__(self):
@@ -437,7 +437,7 @@ def make_extra_axioms():
 def record_grasshopper_task(constraints, basename):
     extra_axioms = make_extra_axioms()
     constraints = extra_axioms + [
-        replace_functions(constraint) for constraint in constraints
+        replace_functions(normal_form(constraint)) for constraint in constraints
     ]
 
     # print("Exporting:", basename)